@@ -15,16 +15,23 @@ from cryptography.hazmat.primitives.asymmetric import ec
 from cryptography.hazmat.primitives import serialization, hashes
 from cryptography.hazmat.backends import default_backend
 import base64
+import functools
 
 # Labrys imports
 
 from src.viewarguments import *
+import src.background as background
+import src.http_client as http_client
+import src.delivery_queue as delivery_queue
 import src.identity_manager as identity_manager
 import src.encryption_manager as encryption_manager
+import src.envelope as envelope
 import src.feed_manager as feed_manager
 import src.permissions_manager as permissions_manager
 import src.subscriptions_manager as subscriptions_manager
 import src.known_blades_manager as known_blades_manager
+import src.log_storage as log_storage
+import src.storage as storage
 import src.timeline_manager as timeline_manager
 import src.public_keys as public_keys
 import src.private_message_manager as private_message_manager
@@ -40,20 +47,31 @@ if not DATA_DIR:
     exit()
 
 
+HTTP_CLIENT = http_client.HTTPClient(DATA_DIR)
+DELIVERY_QUEUE = delivery_queue.DeliveryQueue(DATA_DIR, HTTP_CLIENT)
+BACKGROUND = background.Background(DATA_DIR)
 IDENTITY_MANAGER = identity_manager.IdentityManager(DATA_DIR)
-ENCRYPTION_MANAGER = encryption_manager.EncryptionManager(IDENTITY_MANAGER)
+ENCRYPTION_MANAGER = encryption_manager.EncryptionManager(
+    DATA_DIR, IDENTITY_MANAGER)
 PERMISSIONS_MANAGER = permissions_manager.PermissionsManager(DATA_DIR)
-FEED_MANAGER = feed_manager.FeedManager(
+KNOWN_BLADES_MANAGER = known_blades_manager.KnownBladesManager(
     DATA_DIR,
-    IDENTITY_MANAGER,
-    PERMISSIONS_MANAGER,
+    HTTP_CLIENT,
 )
-KNOWN_BLADES_MANAGER = known_blades_manager.KnownBladesManager(DATA_DIR)
 SUBSCRIPTIONS_MANAGER = subscriptions_manager.SubscriptionsManager(
     DATA_DIR,
     IDENTITY_MANAGER,
     ENCRYPTION_MANAGER,
     KNOWN_BLADES_MANAGER,
+    HTTP_CLIENT,
+    DELIVERY_QUEUE,
+    BACKGROUND,
+)
+FEED_MANAGER = feed_manager.FeedManager(
+    DATA_DIR,
+    IDENTITY_MANAGER,
+    PERMISSIONS_MANAGER,
+    SUBSCRIPTIONS_MANAGER,
 )
 TIMELINE_MANAGER = timeline_manager.TimelineManager(
     DATA_DIR,
@@ -67,7 +85,31 @@ PRIVATE_MESSAGE_MANAGER = private_message_manager.PrivateMessageManager(
     ENCRYPTION_MANAGER,
     KNOWN_BLADES_MANAGER,
     SUBSCRIPTIONS_MANAGER,
+    TIMELINE_MANAGER,
+    HTTP_CLIENT,
+    DELIVERY_QUEUE,
+    BACKGROUND,
 )
+BladeAuthorization.configure(DATA_DIR)
+
+
+# With the reloader, which debug mode turns on, this module is loaded both in
+# a process that only watches for changes and in the one it starts to serve
+# requests, which Werkzeug marks with WERKZEUG_RUN_MAIN. The background
+# threads are only started in the one that serves, so that there's only ever
+# one of each working on the storage.
+def serving_process():
+    reloading = __name__ == '__main__' or app.debug
+    return not reloading or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+
+if serving_process():
+    DELIVERY_QUEUE.start()
+    TIMELINE_MANAGER.start_refresher()
+
+    STORAGE = storage.open_storage(DATA_DIR)
+    if isinstance(STORAGE, log_storage.LogStorage):
+        STORAGE.start_compactor()
 
 # The Session Secret Key is used to sign cookies.
 app.secret_key = IDENTITY_MANAGER.unsafe_session_secret_key()
@@ -187,7 +229,19 @@ def timeline(last_seen):
 
     messages, next_last_seen = TIMELINE_MANAGER.timeline(last_seen)
 
-    return render_template('timeline.html', logged_in=True, messages=messages, next_last_seen=next_last_seen)
+    return render_template('timeline.html', logged_in=True, messages=messages, next_last_seen=next_last_seen, last_refreshed=TIMELINE_MANAGER.last_refreshed)
+
+
+# The timeline refresh endpoint refreshes the user's timeline right away,
+# rather than waiting for the next background refresh.
+@app.route('/timeline/refresh', methods=['POST'])
+def timeline_refresh():
+    if not session.get('authenticated') == 'authenticated':
+        return redirect('/')
+
+    TIMELINE_MANAGER.refresh()
+
+    return redirect('/timeline')
 
 
 @app.route('/timeline/<message_id>', methods=['GET'])
@@ -323,6 +377,18 @@ def api_identity_avatar():
         return send_from_directory(IDENTITY_MANAGER.identity_dir, avatar_file_name)
 
 
+def identity_etag():
+    return IDENTITY_MANAGER.identity_bundle()['version']
+
+
+# Gets the whole identity at once: the public signing key, display name, bio
+# and a hash of the avatar.
+@app.route('/api/identity', methods=['GET'])
+@if_none_match(identity_etag)
+def api_identity():
+    return json.dumps(IDENTITY_MANAGER.identity_bundle()), 200
+
+
 # Gets the display name
 @app.route('/api/identity/display_name', methods=['GET'])
 def api_identity_display_name():
@@ -394,9 +460,41 @@ def api_inbox_delete(message_id):
     return 'ok', 200
 
 
+# Looks up the session that a blade's authorization resumes, if it resumes
+# one. A blade whose session has expired is told so with a 401, and does a
+# full handshake instead.
+def resume_session(f):
+    @functools.wraps(f)
+    def decorated_function(authorization, *args, **kwargs):
+        if authorization is not None and 'session_id' in authorization:
+            authorization = ENCRYPTION_MANAGER.resume_session(authorization)
+            if authorization is None:
+                return 'session expired', 401
+
+        return f(authorization, *args, **kwargs)
+
+    return decorated_function
+
+
+# Encrypts a response to another blade, as a binary envelope if the blade
+# accepts one, or as JSON if not.
+def encrypted_response(authorization, message):
+    # which form the response takes depends on the Accept header
+    headers = {'Vary': 'Accept'}
+
+    if request.accept_mimetypes.best_match(['application/json', envelope.MIMETYPE]) == envelope.MIMETYPE:
+        return Response(ENCRYPTION_MANAGER.encrypt_server_response_envelope(authorization, message),
+                        200,
+                        headers,
+                        mimetype=envelope.MIMETYPE)
+
+    return json.dumps(ENCRYPTION_MANAGER.encrypt_server_response(authorization, message)), 200, headers
+
+
 # The /api/outbox endpoint is where incoming private message notifications go.
 @app.route('/api/outbox', methods=['GET'])
 @many_header_params(BladeAuthorization)
+@resume_session
 def api_outbox_get(authorization):
 
     if authorization is None:
@@ -408,11 +506,7 @@ def api_outbox_get(authorization):
 
             messages += [msg]
 
-    encrypted_messages = ENCRYPTION_MANAGER.encrypt_server_response(
-        authorization,
-        json.dumps(messages))
-
-    return json.dumps(encrypted_messages), 200
+    return encrypted_response(authorization, json.dumps(messages))
 
 
 @app.route('/api/outbox', methods=['POST'])
@@ -434,43 +528,34 @@ def api_outbox_delete(message_id):
     return 'ok', 200
 
 
+# The ETag of the feed changes whenever the feed or anyone's permissions
+# change, so a blade polling the feed can be told that nothing has changed
+# without the feed being read or the response being encrypted.
+def feed_etag():
+    return FEED_MANAGER.feed_version + '.' + PERMISSIONS_MANAGER.permissions_version
+
+
 # The /api/feed endpoint provides the public broadcast messages from this blade.
 @app.route('/api/feed', methods=['GET'])
+@if_none_match(feed_etag)
 @many_query_params(FeedOptions)
 @many_header_params(BladeAuthorization)
+@resume_session
 def api_feed_get(authorization, last_seen):
 
-    if last_seen:
-        found = FEED_MANAGER.message_with_id(last_seen)
-        if found:
-            messages = FEED_MANAGER.messages_after(found)
-        else:
-            messages = FEED_MANAGER.all_messages()
-    else:
-        messages = FEED_MANAGER.all_messages()
-
     if authorization:
-        messages = [msg for msg in messages if PERMISSIONS_MANAGER.permitted_to_view_message(
-            authorization['public_signing_key'], msg['permissions_categories'])]
-
-        for msg in messages:
-            msg.pop('permissions_categories', None)
+        messages = FEED_MANAGER.feed_snapshot(
+            last_seen,
+            PERMISSIONS_MANAGER.effective_permissions(authorization['public_signing_key']))
 
-        encrypted_message = ENCRYPTION_MANAGER.encrypt_server_response(
-            authorization,
-            json.dumps(messages))
-
-        return json.dumps(encrypted_message), 200
+        return encrypted_response(authorization, messages)
 
     else:
 
-        messages = [msg for msg in messages if PERMISSIONS_MANAGER.permitted_to_view_message(
-            None, msg['permissions_categories'])]
-
-        for msg in messages:
-            msg.pop('permissions_categories', None)
-
-        return json.dumps({'messages': messages}), 200
+        return FEED_MANAGER.feed_snapshot(
+            last_seen,
+            PERMISSIONS_MANAGER.effective_permissions(None),
+            as_object=True), 200
 
 
 @app.route('/api/feed', methods=['POST'])
@@ -499,11 +584,16 @@ def feed_attachments_id_get(attachment_name):
 
 @app.route('/api/subscriptions', methods=['GET'])
 @require_authentication
-def api_subscriptions_get():
+@many_query_params(PageAPIOptions)
+def api_subscriptions_get(last_seen, version):
 
-    subs = SUBSCRIPTIONS_MANAGER.subscriptions()
+    subs, next_last_seen = SUBSCRIPTIONS_MANAGER.subscriptions(last_seen)
+
+    # version 1 is the response older clients expect
+    if version == 1:
+        return json.dumps([subs, next_last_seen])
 
-    return json.dumps(subs)
+    return json.dumps({'subscriptions': subs, 'next_last_seen': next_last_seen})
 
 
 @app.route('/api/subscriptions', methods=['POST'])
@@ -648,11 +738,38 @@ def api_permissions_blades_id_delete(blade_id):
 # The /api/timeline endpoint provides the current timeline for this blade.
 @app.route('/api/timeline', methods=['GET'])
 @require_authentication
-def api_timeline_get():
+@many_query_params(PageAPIOptions)
+def api_timeline_get(last_seen, version):
+
+    messages, next_last_seen = TIMELINE_MANAGER.timeline(last_seen)
+
+    # version 1 is the response older clients expect
+    if version == 1:
+        return json.dumps([messages, next_last_seen]), 200
+
+    return json.dumps({'messages': messages, 'next_last_seen': next_last_seen, 'last_refreshed': TIMELINE_MANAGER.last_refreshed}), 200
+
 
-    messages = TIMELINE_MANAGER.timeline()
+# The /api/timeline/refresh endpoint refreshes the timeline right away.
+@app.route('/api/timeline/refresh', methods=['POST'])
+@require_authentication
+def api_timeline_refresh():
+
+    last_refreshed = TIMELINE_MANAGER.refresh()
+
+    return json.dumps({'last_refreshed': last_refreshed}), 200
+
+
+# The /api/status endpoint provides statistics about the blade's connections
+# to other blades, and about the caches that serve other blades' requests.
+@app.route('/api/status', methods=['GET'])
+@require_authentication
+def api_status_get():
 
-    return json.dumps(messages), 200
+    return json.dumps({'http_client': HTTP_CLIENT.stats(),
+                       'peers': HTTP_CLIENT.peer_health.stats(),
+                       'authorization_cache': BladeAuthorization.cache.stats(),
+                       'feed_snapshot_cache': FEED_MANAGER.snapshots.stats()}), 200
 
 
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+import argparse
+import os
+import sys
+
+import src.timeline_manager as timeline_manager
+
+
+parser = argparse.ArgumentParser(
+    description='Removes duplicate copies of messages from the timeline cache of a labrys blade. The blade should not be running while this happens.')
+parser.add_argument(
+    '<data-dir>', help='The directory that the blade stores its labrys data in.')
+args = vars(parser.parse_args())
+
+if not os.path.isdir(args['<data-dir>']):
+    print('No such data directory: ' + args['<data-dir>'])
+    sys.exit(1)
+
+# Deduplicating only touches the timeline cache, so none of the other
+# managers are needed.
+manager = timeline_manager.TimelineManager(
+    args['<data-dir>'], None, None, None)
+
+print('Removed ' + str(manager.deduplicate_timeline_cache()) +
+      ' duplicate messages from the timeline cache.')
@@ -0,0 +1,55 @@
+import argparse
+import os
+import sys
+
+import src.config as config
+import src.storage as storage
+
+
+def migrate(data_dir, backend):
+    current_backend = config.load_config(data_dir)['storage_backend']
+
+    if current_backend == backend:
+        print('This blade already uses the ' + backend + ' storage backend.')
+        return False
+
+    if current_backend in storage.JSON_FILE_BACKENDS and backend in storage.JSON_FILE_BACKENDS:
+        config.save_config(data_dir, {'storage_backend': backend})
+        return True
+
+    source = storage.open_storage(data_dir, current_backend)
+    destination = storage.open_storage(data_dir, backend)
+
+    for name in storage.TABLE_FILES:
+        if len(destination.table(name)) != 0:
+            print('The ' + backend + ' storage for this blade already has data in the ' +
+                  name + ' table. Not migrating.')
+            return False
+
+    with destination.batch():
+        for name in storage.TABLE_FILES:
+            docs = source.table(name).all()
+            print('Migrating ' + str(len(docs)) + ' records from ' + name)
+            destination.table(name).insert_multiple([dict(doc) for doc in docs])
+
+    config.save_config(data_dir, {'storage_backend': backend})
+
+    return True
+
+
+parser = argparse.ArgumentParser(
+    description='Moves the data of a labrys blade into a different storage backend. The blade should not be running while this happens.')
+parser.add_argument(
+    '<data-dir>', help='The directory that the blade stores its labrys data in.')
+parser.add_argument('<backend>', choices=sorted(storage.BACKENDS),
+                    help='The storage backend to move the data into.')
+args = vars(parser.parse_args())
+
+if not os.path.isdir(args['<data-dir>']):
+    print('No such data directory: ' + args['<data-dir>'])
+    sys.exit(1)
+
+if migrate(args['<data-dir>'], args['<backend>']):
+    print('Migration complete.')
+else:
+    sys.exit(1)
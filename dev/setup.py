@@ -7,6 +7,7 @@ import sys
 import time
 
 
+import src.config as config
 import src.passwords as passwords
 
 
@@ -21,6 +22,9 @@ def noninteractive(data_dir, canonical_url, display_name, bio, password):
     with open(os.path.join(data_dir, 'blade_url.txt'), 'w') as f:
         f.write(canonical_url)
 
+    # new blades keep their data in sqlite rather than in json files
+    config.save_config(data_dir, {'storage_backend': 'sqlite'})
+
     with open(os.path.join(data_dir, 'identity', 'display_name.txt'), 'w') as f:
         f.write(display_name)
 
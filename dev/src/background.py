@@ -0,0 +1,29 @@
+import concurrent.futures
+
+import src.config as config
+
+
+# The Background runs work that has to wait on other blades, such as loading
+# the identity of a blade we've just subscribed to, on a pool of threads, so
+# that handling a request never waits on another blade. Nothing waits for the
+# result of the work, so if it fails the error is printed instead.
+class Background(object):
+
+    def __init__(self, data_dir):
+        cfg = config.load_config(data_dir)
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=cfg['background_concurrency'])
+
+    # Runs `f(*args)` in the background. `description` says what it's doing
+    # if it fails.
+    def run(self, description, f, *args):
+        future = self.executor.submit(f, *args)
+        future.add_done_callback(
+            lambda future: _print_failure(description, future))
+        return future
+
+
+def _print_failure(description, future):
+    e = future.exception()
+    if e is not None:
+        print('BACKGROUND WORK FAILED', description, repr(e))
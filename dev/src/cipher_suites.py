@@ -0,0 +1,167 @@
+import os
+
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.hazmat.primitives.asymmetric import ec, x25519
+from cryptography.hazmat.primitives.ciphers.aead import ChaCha20Poly1305
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import base64
+
+
+# A cipher suite is the kind of Diffie-Hellman key that blades exchange in a
+# handshake, and the cipher they encrypt responses with using the key they
+# agree on. Each suite generates private keys, serializes public keys to the
+# bytes that are signed and sent, and turns a peer's serialized public key
+# and a private key into a cipher, which has `encrypt` and `decrypt` methods
+# from bytes to bytes. `decrypt` also accepts a memoryview. Both take
+# associated data, which isn't encrypted but has to be the same for the
+# ciphertext to decrypt.
+#
+# `valid_public_key` says whether bytes a peer sent are a public key of the
+# suite's kind, so that a bad key can be rejected before it's used. `cipher`
+# raises ValueError if it isn't.
+
+
+# The suite blades have always used, which is what a blade that doesn't say
+# which suite it's using means: SECP384R1 keys in PEM, and Fernet.
+class P384Fernet(object):
+
+    name = 'p384-fernet'
+
+    @staticmethod
+    def generate_private_key():
+        return ec.generate_private_key(ec.SECP384R1(), default_backend())
+
+    @staticmethod
+    def serialize_public_key(private_key):
+        return private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+
+    @staticmethod
+    def valid_public_key(serialized_public_key):
+        try:
+            public_key = serialization.load_pem_public_key(
+                serialized_public_key,
+                backend=default_backend())
+        except (ValueError, TypeError):
+            return False
+
+        return isinstance(public_key, ec.EllipticCurvePublicKey) and isinstance(public_key.curve, ec.SECP384R1)
+
+    @staticmethod
+    def cipher(private_key, serialized_peer_public_key):
+        peer_public_key = serialization.load_pem_public_key(
+            serialized_peer_public_key,
+            backend=default_backend())
+
+        if not isinstance(peer_public_key, ec.EllipticCurvePublicKey) or not isinstance(peer_public_key.curve, ec.SECP384R1):
+            raise ValueError('not a SECP384R1 public key')
+
+        shared_key = private_key.exchange(ec.ECDH(), peer_public_key)
+
+        derived_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'handshake data',
+            backend=default_backend()).derive(shared_key)
+
+        return FernetCipher(derived_key)
+
+
+# Fernet has no associated data, so it's put in front of the plaintext, and
+# checked and taken off again when decrypting.
+class FernetCipher(object):
+
+    def __init__(self, key):
+        self.fernet = Fernet(base64.urlsafe_b64encode(key))
+
+    def encrypt(self, data, associated_data=b''):
+        return self.fernet.encrypt(associated_data + data)
+
+    def decrypt(self, data, associated_data=b''):
+        plaintext = self.fernet.decrypt(bytes(data))
+        if not plaintext.startswith(associated_data):
+            raise InvalidToken
+        return plaintext[len(associated_data):]
+
+
+# Raw 32 byte X25519 keys, and ChaCha20-Poly1305, which is much faster than
+# P-384 and AES on boards without AES instructions.
+class X25519ChaCha20Poly1305(object):
+
+    name = 'x25519-chacha20poly1305'
+
+    @staticmethod
+    def generate_private_key():
+        return x25519.X25519PrivateKey.generate()
+
+    @staticmethod
+    def serialize_public_key(private_key):
+        return private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.Raw,
+            format=serialization.PublicFormat.Raw)
+
+    # Any 32 bytes decode as a key, but keys of small order, such as all
+    # zeroes, give an all zero shared key, which `exchange` refuses. Trying an
+    # exchange with a throwaway key catches them before they're used.
+    @staticmethod
+    def valid_public_key(serialized_public_key):
+        if len(serialized_public_key) != 32:
+            return False
+
+        try:
+            x25519.X25519PrivateKey.generate().exchange(
+                x25519.X25519PublicKey.from_public_bytes(serialized_public_key))
+        except ValueError:
+            return False
+
+        return True
+
+    @staticmethod
+    def cipher(private_key, serialized_peer_public_key):
+        # `exchange` raises ValueError itself for keys of small order
+        if len(serialized_peer_public_key) != 32:
+            raise ValueError('X25519 public keys are 32 bytes')
+
+        peer_public_key = x25519.X25519PublicKey.from_public_bytes(
+            serialized_peer_public_key)
+
+        shared_key = private_key.exchange(peer_public_key)
+
+        derived_key = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=None,
+            info=b'labrys x25519-chacha20poly1305',
+            backend=default_backend()).derive(shared_key)
+
+        return ChaCha20Poly1305Cipher(derived_key)
+
+
+# Encrypted messages are a random 12 byte nonce followed by the ciphertext.
+class ChaCha20Poly1305Cipher(object):
+
+    def __init__(self, key):
+        self.aead = ChaCha20Poly1305(key)
+
+    def encrypt(self, data, associated_data=b''):
+        nonce = os.urandom(12)
+        return nonce + self.aead.encrypt(nonce, data, associated_data)
+
+    def decrypt(self, data, associated_data=b''):
+        return self.aead.decrypt(data[:12], data[12:], associated_data)
+
+
+SUITES = {suite.name: suite for suite in [P384Fernet, X25519ChaCha20Poly1305]}
+
+# The suites this blade supports, most preferred first.
+PREFERENCE = [X25519ChaCha20Poly1305.name, P384Fernet.name]
+
+DEFAULT = P384Fernet.name
+
+# The errors a cipher raises when the data it's given doesn't decrypt.
+DECRYPTION_ERRORS = (InvalidToken, InvalidTag)
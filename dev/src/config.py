@@ -0,0 +1,111 @@
+import json
+import os
+
+
+# The default settings for a blade. Any of these can be overridden by putting
+# the setting in the `config.json` file in the blade's data directory.
+DEFAULTS = {
+    'storage_backend': 'json',
+
+    # log storage backend
+    'log_segment_size': 1024 * 1024,
+    'log_compaction_interval': 600,
+    'log_fsync': True,
+
+    # timeline cache retention; each of these is off unless it's set
+    'timeline_retention_max_age_days': None,
+    'timeline_retention_max_messages': None,
+    'timeline_retention_max_per_subscription': None,
+
+    # fetching subscriptions; the timeout is in seconds, per subscription
+    'subscription_fetch_concurrency': 8,
+    'subscription_fetch_timeout': 30,
+
+    # requests to other blades; timeouts are in seconds, and the pool sizes are
+    # the number of blades to keep connections to and the number of
+    # connections to keep to each one
+    'http_connect_timeout': 30,
+    'http_read_timeout': 60,
+    'http_retries': 2,
+    'http_retry_backoff': 0.5,
+    'http_pool_connections': 16,
+    'http_pool_maxsize': 8,
+
+    # delivering notifications to other blades; the backoff, in seconds, is
+    # doubled after every failed attempt, up to the maximum
+    'delivery_concurrency': 8,
+    'delivery_backoff': 5,
+    'delivery_max_backoff': 3600,
+    'delivery_max_attempts': 20,
+
+    # how many requests to other blades that nothing is waiting on, such as
+    # loading a new subscription's identity, can be made at once
+    'background_concurrency': 4,
+
+    # a blade that fails this many requests in a row is treated as
+    # unavailable, and only tried again after the cooldown, in seconds
+    'peer_failure_threshold': 3,
+    'peer_cooldown': 60,
+
+    # encrypted sessions between blades; how long, in seconds, a session can
+    # be resumed before a new key has to be agreed, and the most sessions to
+    # keep at once
+    'session_ttl': 60 * 60,
+    'session_cache_size': 1024,
+
+    # how long, in seconds, to remember which cipher suite another blade
+    # prefers before asking it again
+    'peer_suite_ttl': 24 * 60 * 60,
+
+    # how many verified handshake authorizations from other blades to keep,
+    # and for how long, in seconds
+    'authorization_cache_size': 1024,
+    'authorization_cache_ttl': 10 * 60,
+
+    # how many serialized snapshots of the feed to keep for blades polling
+    # it, and for how long, in seconds
+    'feed_snapshot_cache_size': 64,
+    'feed_snapshot_ttl': 10 * 60,
+
+    # how long, in seconds, before known blades' avatars are checked for
+    # changes
+    'avatar_ttl': 24 * 60 * 60,
+
+    # how often, in seconds, each subscription is polled; subscriptions that
+    # post often are polled more often, and quiet or unreachable ones less
+    # often, within these limits
+    'subscription_poll_min_interval': 300,
+    'subscription_poll_max_interval': 24 * 60 * 60,
+
+    # how often, in seconds, the timeline is refreshed in the background by
+    # polling the subscriptions that are due; set to null to only refresh when
+    # asked to
+    'timeline_refresh_interval': 60,
+}
+
+
+def config_file(data_dir):
+    return os.path.join(data_dir, 'config.json')
+
+
+def load_config(data_dir):
+    cfg = dict(DEFAULTS)
+
+    if os.path.exists(config_file(data_dir)):
+        with open(config_file(data_dir), 'r') as f:
+            cfg.update(json.load(f))
+
+    return cfg
+
+
+def save_config(data_dir, overrides):
+    cfg = {}
+
+    if os.path.exists(config_file(data_dir)):
+        with open(config_file(data_dir), 'r') as f:
+            cfg = json.load(f)
+
+    cfg.update(overrides)
+
+    with open(config_file(data_dir), 'w') as f:
+        json.dump(cfg, f, indent=2)
@@ -0,0 +1,54 @@
+import base64
+import binascii
+import json
+
+
+# A cursor marks a position in a list of records by the (datetime, id) key of
+# the last record seen, so that the next page can be found by seeking straight
+# to that key. Cursors are opaque to clients.
+def encode_cursor(key):
+    return str(base64.urlsafe_b64encode(bytes(json.dumps(list(key)), encoding='ascii')),
+               encoding='ascii').rstrip('=')
+
+
+def decode_cursor(s):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(
+            bytes(s + '=' * (-len(s) % 4), encoding='ascii')))
+    except (ValueError, binascii.Error):
+        return None
+
+    if not (isinstance(key, list) and len(key) == 2 and all(isinstance(k, str) for k in key)):
+        return None
+
+    return tuple(key)
+
+
+# Older blades send the bare id of the last record they saw instead of a
+# cursor, so anything that doesn't decode as a cursor is kept as an id.
+def parse_last_seen(s):
+    key = decode_cursor(s)
+    if key is None:
+        return s
+    return key
+
+
+# Gets the id of the record that a `last_seen` string refers to. Older blades
+# only understand ids, so this is what is sent to other blades.
+def id_for_last_seen(s):
+    key = decode_cursor(s)
+    if key is None:
+        return s
+    return key[1]
+
+
+def cursor_for(record, datetime_field='publish_datetime'):
+    return encode_cursor((record[datetime_field], record['id']))
+
+
+# Resolves a parsed `last_seen` value to a key in `index`. Cursors carry their
+# key with them, so only bare ids need to be looked up.
+def key_for_last_seen(last_seen, index):
+    if last_seen is None or isinstance(last_seen, tuple):
+        return last_seen
+    return index.key_for_id(last_seen)
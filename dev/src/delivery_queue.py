@@ -0,0 +1,171 @@
+import concurrent.futures
+import datetime
+import random
+import threading
+
+import requests
+
+import src.config as config
+import src.peer_health as peer_health
+import src.storage as storage
+
+
+# The DeliveryQueue sends notifications to other blades' inboxes in the
+# background, so that nothing a user does waits on another blade. Queued
+# deliveries are kept in storage until they succeed, so they survive the blade
+# restarting. A delivery that fails is retried with exponential backoff, and
+# the deliveries to each blade are always made in the order they were queued.
+class DeliveryQueue(object):
+
+    def __init__(self, data_dir, http_client):
+        self.data_dir = data_dir
+        self.http_client = http_client
+        self.storage = storage.open_storage(self.data_dir)
+        self.delivery_queue_db = self.storage.table('delivery_queue')
+
+        cfg = config.load_config(self.data_dir)
+        self.concurrency = cfg['delivery_concurrency']
+        self.backoff = cfg['delivery_backoff']
+        self.max_backoff = cfg['delivery_max_backoff']
+        self.max_attempts = cfg['delivery_max_attempts']
+
+        self.lock = threading.Lock()
+        # the ids of the deliveries being posted right now
+        self.in_flight = set()
+        self.next_sequence = 1 + max([d['sequence'] for d in self.delivery_queue_db.all()],
+                                     default=0)
+        self.delivery_wanted = threading.Event()
+        self.worker_thread = None
+
+    def start(self):
+        if self.worker_thread is None:
+            self.worker_thread = threading.Thread(
+                target=self._worker_loop, daemon=True)
+            self.worker_thread.start()
+
+    # Queues `payload` to be posted to `url`. If the same payload is already
+    # waiting to be posted to the same url, it isn't queued again, since the
+    # blade receiving it would only do the same thing twice. A delivery that
+    # is already being posted might have been acted on before whatever this
+    # one is about happened, so that doesn't count.
+    #
+    # Callers can enqueue inside a batch, which holds the storage's lock, so
+    # the storage is always locked before the queue, or two threads
+    # enqueueing at once could each wait for the other's lock.
+    def enqueue(self, url, payload):
+        with self.storage.batch(), self.lock:
+            for delivery in self.delivery_queue_db.search(url=url):
+                if delivery['payload'] == payload and delivery['id'] not in self.in_flight:
+                    return
+
+            self.delivery_queue_db.insert({
+                'id': ''.join([random.choice('0123456789abcdef')
+                               for i in range(30)]),
+                'sequence': self.next_sequence,
+                'url': url,
+                'payload': payload,
+                'enqueue_datetime': datetime.datetime.utcnow().isoformat(),
+                'attempts': 0,
+                'next_attempt_datetime': None
+            })
+            self.next_sequence += 1
+
+        self.delivery_wanted.set()
+
+    def _worker_loop(self):
+        while True:
+            try:
+                wait = self.deliver_due()
+            except Exception as e:
+                print('DELIVERY FAILED', e)
+                wait = self.backoff
+
+            self.delivery_wanted.wait(wait)
+            self.delivery_wanted.clear()
+
+    # Makes every delivery that is due, working through the deliveries to
+    # different urls concurrently. Returns how many seconds to wait before the
+    # next delivery is due, or None if there are none left.
+    def deliver_due(self):
+        by_url = {}
+        for delivery in sorted(self.delivery_queue_db.all(), key=lambda d: d['sequence']):
+            by_url.setdefault(delivery['url'], []).append(delivery)
+
+        if not by_url:
+            return None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self.concurrency, len(by_url))) as executor:
+            waits = list(executor.map(self.deliver_in_order, by_url.values()))
+
+        waits = [wait for wait in waits if wait is not None]
+        if not waits:
+            return None
+        return min(waits)
+
+    # Makes the deliveries to one url in order, stopping at the first one
+    # that isn't due yet or fails, so that later deliveries never overtake
+    # it. Returns how many seconds until the first remaining delivery is due,
+    # or None if there are none left.
+    def deliver_in_order(self, deliveries):
+        for delivery in deliveries:
+            now = datetime.datetime.utcnow()
+            if delivery['next_attempt_datetime'] is not None:
+                next_attempt = datetime.datetime.fromisoformat(
+                    delivery['next_attempt_datetime'])
+                if next_attempt > now:
+                    return (next_attempt - now).total_seconds()
+
+            delivered = self.deliver(delivery)
+
+            # a blade whose circuit is open wasn't tried at all, so that
+            # doesn't count as an attempt, and it's tried again once the
+            # circuit might have closed
+            if delivered is None:
+                wait = self.http_client.peer_health.cooldown
+                self.delivery_queue_db.update({
+                    'next_attempt_datetime': (now + datetime.timedelta(seconds=wait)).isoformat()
+                }, id=delivery['id'])
+                return wait
+
+            if not delivered:
+                attempts = delivery['attempts'] + 1
+                if attempts >= self.max_attempts:
+                    print('GIVING UP ON DELIVERY', delivery['url'])
+                    self.delivery_queue_db.remove(id=delivery['id'])
+                    continue
+
+                wait = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+                self.delivery_queue_db.update({
+                    'attempts': attempts,
+                    'next_attempt_datetime': (now + datetime.timedelta(seconds=wait)).isoformat()
+                }, id=delivery['id'])
+                return wait
+
+            self.delivery_queue_db.remove(id=delivery['id'])
+
+        return None
+
+    # Posts a delivery. Returns False if it should be tried again later, or
+    # None if it wasn't posted because the blade is unavailable. A blade that
+    # rejects the delivery outright won't accept it later either, so that
+    # counts as done.
+    def deliver(self, delivery):
+        with self.lock:
+            self.in_flight.add(delivery['id'])
+
+        try:
+            resp = self.http_client.post(delivery['url'],
+                                         data=delivery['payload'])
+        except peer_health.PeerUnavailable:
+            return None
+        except requests.exceptions.RequestException as e:
+            print('FAILED TO DELIVER', delivery['url'], e)
+            return False
+        finally:
+            with self.lock:
+                self.in_flight.discard(delivery['id'])
+
+        if 400 <= resp.status_code < 500:
+            print('DELIVERY REJECTED', delivery['url'], resp.status_code)
+
+        return resp.status_code < 500
@@ -1,147 +1,296 @@
 import base64
-from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.hazmat.primitives.asymmetric import ec
-from cryptography.hazmat.primitives.kdf.hkdf import HKDF
-from cryptography.fernet import Fernet
 import json
 import nacl
-
-
+import secrets
+
+import src.cipher_suites as cipher_suites
+import src.config as config
+import src.envelope as envelope
+import src.signing_keys as signing_keys
+import src.ttl_cache as ttl_cache
+
+
+# The EncryptionManager encrypts the responses that blades send each other.
+# The first request a blade makes to another does a full Diffie-Hellman
+# handshake, and the key they agree on is kept as a session for
+# `session_ttl` seconds. Later requests resume the session by sending its id
+# instead of doing the handshake again. Once the session expires, the next
+# request does a new handshake, which agrees on a new key.
+#
+# Handshakes use the cipher suite the server prefers out of the ones the
+# client supports, which the server lists in its response to the first
+# handshake. Until then, and with blades that don't list any, the default
+# suite is used.
 class EncryptionManager(object):
 
-    def __init__(self, identity_manager):
+    def __init__(self, data_dir, identity_manager):
+        self.data_dir = data_dir
         self.identity_manager = identity_manager
 
+        cfg = config.load_config(self.data_dir)
+        self.session_ttl = cfg['session_ttl']
+
+        # session id -> {'public_signing_key', 'cipher'}, for the sessions
+        # other blades have started with this one
+        self.server_sessions = ttl_cache.TTLCache(
+            cfg['session_cache_size'], self.session_ttl)
+
+        # server public signing key -> {'session_id', 'cipher'}, for the
+        # sessions this blade has started with other blades
+        self.client_sessions = ttl_cache.TTLCache(
+            cfg['session_cache_size'], self.session_ttl)
+
+        # server public signing key -> the name of the cipher suite to use
+        # with that blade, which is learned again once it expires in case the
+        # blade has changed which suites it supports
+        self.peer_suites = ttl_cache.TTLCache(
+            cfg['session_cache_size'], cfg['peer_suite_ttl'])
+
     def encrypted_client_request(self, server_public_signing_key, req_func, *args, **kwargs):
-        private_signing_key = self.identity_manager.unsafe_private_signing_key()
+        return self.encrypted_client_request_with_response(
+            server_public_signing_key, req_func, *args, **kwargs)[1]
+
+    # Makes an encrypted request like encrypted_client_request, but returns
+    # the response along with the decrypted content, for callers that need
+    # its status or headers.
+    def encrypted_client_request_with_response(self, server_public_signing_key, req_func, *args, **kwargs):
         public_signing_key = self.identity_manager.public_signing_key()
 
+        # ##### Session Resumption #################################################
+
+        # Every resumed request sends a new nonce, which the response has to
+        # be encrypted with, so that an earlier response on the same session
+        # can't be replayed.
+        session = self.client_sessions.get(server_public_signing_key)
+        if session is not None:
+            nonce = secrets.token_hex(16)
+            resp = req_func(*args, **_with_authorization(kwargs, {
+                'public_signing_key': public_signing_key,
+                'session_id': session['session_id'],
+                'nonce': nonce}))
+
+            if resp.status_code != 401:
+                try:
+                    return resp, _decrypt_session_response(session, nonce, resp)
+                except SESSION_RESPONSE_ERRORS as e:
+                    print('BAD SESSION RESPONSE', repr(e))
+
+            # the server has forgotten the session, or its response didn't
+            # decrypt, so start a new one
+            self.client_sessions.pop(server_public_signing_key)
+
         # ##### DH Session Setup ###################################################
 
-        dh_private_key = ec.generate_private_key(
-            ec.SECP384R1(), default_backend())
+        # the first handshake with a blade uses the default suite, and its
+        # response says which suites it supports
+        suite_name = self.peer_suites.get(
+            server_public_signing_key, cipher_suites.DEFAULT)
+        suite = cipher_suites.SUITES[suite_name]
 
-        dh_public_key = dh_private_key.public_key()
+        dh_private_key = suite.generate_private_key()
 
-        serialized_dh_public_key = dh_public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        serialized_dh_public_key = suite.serialize_public_key(dh_private_key)
 
-        signing_key = nacl.signing.SigningKey(private_signing_key.encode(
-            encoding='ascii'), encoder=nacl.encoding.Base64Encoder)
-        signed_serialized_dh_public_key = signing_key.sign(
+        signed_serialized_dh_public_key = self.identity_manager.signing_key().sign(
             serialized_dh_public_key).signature
 
         # ##### DH Auth Header Info ################################################
 
-        authorization_header = {'Authorization': 'LabrysBlade ' + json.dumps({
+        authorization = {
             'public_signing_key': public_signing_key,
             'dh_public_key': str(base64.urlsafe_b64encode(serialized_dh_public_key), encoding='ascii'),
-            'signed_dh_public_key': str(base64.urlsafe_b64encode(signed_serialized_dh_public_key), encoding='ascii')})}
+            'signed_dh_public_key': str(base64.urlsafe_b64encode(signed_serialized_dh_public_key), encoding='ascii')}
+
+        if suite_name != cipher_suites.DEFAULT:
+            authorization['suite'] = suite_name
 
         # ##### Request ############################################################
 
-        if 'headers' in kwargs:
-            kwargs['headers'] = {**kwargs['headers'], **authorization_header}
-        else:
-            kwargs['headers'] = authorization_header
+        resp = req_func(*args, **_with_authorization(kwargs, authorization))
 
-        resp = req_func(*args, **kwargs)
+        encrypted_response = _read_encrypted_response(resp)
 
-        if resp.status_code != 200:
-            return None
+        if encrypted_response is None:
+            # a blade that can't do the suite it said it could, such as one
+            # that has been downgraded, gets the default suite next time
+            if resp.status_code != 304:
+                self.peer_suites.pop(server_public_signing_key)
+            return resp, None
 
-        resp_data = resp.json()
+        # ##### DH Decryption ######################################################
 
-        if 'encryption_info' not in resp_data:
-            return None
+        encryption_info, ciphertext = encrypted_response
 
-        # ##### DH Decryption ######################################################
+        if encryption_info.get('suite', cipher_suites.DEFAULT) != suite_name:
+            return resp, None
 
-        if 'encryption_info' not in resp_data or 'encrypted_content' not in resp_data:
-            return None
+        supported_suites = encryption_info.get('suites')
+        if isinstance(supported_suites, list):
+            for name in cipher_suites.PREFERENCE:
+                if name in supported_suites:
+                    self.peer_suites.put(server_public_signing_key, name)
+                    break
 
-        server_public_signing_key = bytes(
-            server_public_signing_key, encoding='ascii')
         server_dh_public_key = base64.urlsafe_b64decode(
-            bytes(resp_data['encryption_info']['dh_public_key'], encoding='ascii'))
+            bytes(encryption_info['dh_public_key'], encoding='ascii'))
         server_signed_dh_public_key = base64.urlsafe_b64decode(
-            bytes(resp_data['encryption_info']['signed_dh_public_key'], encoding='ascii'))
+            bytes(encryption_info['signed_dh_public_key'], encoding='ascii'))
 
-        verify_key = nacl.signing.VerifyKey(server_public_signing_key,
-                                            encoder=nacl.encoding.Base64Encoder)
+        verify_key = signing_keys.verify_key(server_public_signing_key)
 
         try:
             verify_key.verify(server_dh_public_key,
                               server_signed_dh_public_key)
-        except nacl.exceptions.BadSignatureError:
-            return None
+        except (nacl.exceptions.BadSignatureError, ValueError):
+            return resp, None
 
-        loaded_server_public_key = serialization.load_pem_public_key(
-            server_dh_public_key,
-            backend=default_backend())
+        if not suite.valid_public_key(server_dh_public_key):
+            return resp, None
 
-        shared_key = dh_private_key.exchange(
-            ec.ECDH(), loaded_server_public_key)
+        cipher = suite.cipher(dh_private_key, server_dh_public_key)
 
-        derived_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b'handshake data',
-            backend=default_backend()).derive(shared_key)
+        try:
+            decrypted_content = str(cipher.decrypt(ciphertext), encoding='ascii')
+        except cipher_suites.DECRYPTION_ERRORS:
+            return resp, None
+
+        # servers that don't support sessions don't send a session id
+        session_id = encryption_info.get('session_id')
+        session_ttl = encryption_info.get('session_ttl')
+        if isinstance(session_id, str) and isinstance(session_ttl, (int, float)):
+            self.client_sessions.put(server_public_signing_key,
+                                     {'session_id': session_id,
+                                      'cipher': cipher},
+                                     min(self.session_ttl, session_ttl))
+
+        return resp, decrypted_content
+
+    # Looks up the session that a client's authorization resumes. Returns the
+    # authorization with the session added, or None if the session has
+    # expired or belongs to a different blade.
+    def resume_session(self, client_authorization):
+        session = self.server_sessions.get(client_authorization['session_id'])
+        if session is None or session['public_signing_key'] != client_authorization['public_signing_key']:
+            return None
+
+        return {**client_authorization, 'session': session}
 
-        fernet_key = base64.urlsafe_b64encode(derived_key)
+    def encrypt_server_response(self, client_authorization, message):
+        encryption_info, ciphertext = self.encrypt_for_client(
+            client_authorization, message)
 
-        decrypted_content = str(Fernet(fernet_key).decrypt(
-            base64.urlsafe_b64decode(bytes(resp_data['encrypted_content'], encoding='ascii'))), encoding='ascii')
+        return {
+            'encryption_info': encryption_info,
+            'encrypted_content': str(base64.urlsafe_b64encode(ciphertext), encoding='ascii')
+        }
 
-        return decrypted_content
+    # Encrypts a response like encrypt_server_response, but as a binary
+    # envelope, for clients that accept one.
+    def encrypt_server_response_envelope(self, client_authorization, message):
+        return envelope.pack(*self.encrypt_for_client(client_authorization, message))
 
-    def encrypt_server_response(self, client_authorization, message):
-        private_signing_key = nacl.signing.SigningKey(self.identity_manager.unsafe_private_signing_key().encode(
-            encoding='ascii'), encoder=nacl.encoding.Base64Encoder)
+    # Encrypts `message` for the client, returning the encryption info and the
+    # raw ciphertext.
+    def encrypt_for_client(self, client_authorization, message):
         public_signing_key = self.identity_manager.public_signing_key().strip()
 
-        server_private_key = ec.generate_private_key(
-            ec.SECP384R1(), default_backend())
+        if 'session' in client_authorization:
+            return {
+                'public_signing_key': public_signing_key,
+                'session_id': client_authorization['session_id'],
+                'nonce': client_authorization['nonce']
+            }, _encrypt(client_authorization['session']['cipher'],
+                        message,
+                        bytes(client_authorization['nonce'], encoding='ascii'))
+
+        private_signing_key = self.identity_manager.signing_key()
 
-        loaded_client_public_key = serialization.load_pem_public_key(
-            client_authorization['dh_public_key'],
-            backend=default_backend())
+        suite_name = client_authorization.get('suite', cipher_suites.DEFAULT)
+        suite = cipher_suites.SUITES[suite_name]
 
-        shared_key = server_private_key.exchange(
-            ec.ECDH(), loaded_client_public_key)
+        server_private_key = suite.generate_private_key()
 
-        derived_key = HKDF(
-            algorithm=hashes.SHA256(),
-            length=32,
-            salt=None,
-            info=b'handshake data',
-            backend=default_backend()).derive(shared_key)
+        cipher = suite.cipher(server_private_key,
+                              client_authorization['dh_public_key'])
 
-        server_public_key = server_private_key.public_key()
-        serialized_server_public_key = server_public_key.public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo)
+        session_id = secrets.token_hex(15)
+        self.server_sessions.put(session_id, {
+            'public_signing_key': client_authorization['public_signing_key'],
+            'cipher': cipher})
+
+        serialized_server_public_key = suite.serialize_public_key(
+            server_private_key)
 
         signed_serialized_server_public_key = private_signing_key.sign(
             serialized_server_public_key).signature
 
-        fernet_key = base64.urlsafe_b64encode(derived_key)
+        return {
+            'public_signing_key': public_signing_key,
+            'suite': suite_name,
+            'suites': cipher_suites.PREFERENCE,
+            'dh_public_key': str(base64.urlsafe_b64encode(
+                serialized_server_public_key), encoding='ascii'),
+            'signed_dh_public_key': str(base64.urlsafe_b64encode(
+                signed_serialized_server_public_key), encoding='ascii'),
+            'session_id': session_id,
+            'session_ttl': self.session_ttl
+        }, _encrypt(cipher, message)
 
-        encrypted_message = str(base64.urlsafe_b64encode(
-            Fernet(fernet_key).encrypt(
-                bytes(message, encoding='ascii'))), encoding='ascii')
 
-        return {
-            'encryption_info': {
-                'public_signing_key': public_signing_key,
-                'dh_public_key': str(base64.urlsafe_b64encode(
-                    serialized_server_public_key), encoding='ascii'),
-                'signed_dh_public_key': str(base64.urlsafe_b64encode(
-                    signed_serialized_server_public_key), encoding='ascii')
-            },
-            'encrypted_content': encrypted_message
-        }
+# Adds the Authorization header to a request's headers, and an Accept header
+# asking for a binary envelope, which blades that don't support them ignore,
+# unless the caller has asked for something else.
+def _with_authorization(kwargs, authorization):
+    headers = dict(kwargs.get('headers') or {})
+    headers['Authorization'] = 'LabrysBlade ' + json.dumps(authorization)
+
+    if not any(name.lower() == 'accept' for name in headers):
+        headers['Accept'] = envelope.MIMETYPE + ', application/json;q=0.9'
+
+    return {**kwargs, 'headers': headers}
+
+
+def _encrypt(cipher, message, associated_data=b''):
+    return cipher.encrypt(bytes(message, encoding='ascii'), associated_data)
+
+
+# Gets the encryption info and the ciphertext from an encrypted response,
+# which is either a binary envelope or JSON, or None if it isn't one.
+def _read_encrypted_response(resp):
+    if resp.status_code != 200:
+        return None
+
+    if resp.headers.get('Content-Type', '').split(';')[0].strip() == envelope.MIMETYPE:
+        return envelope.unpack(resp.content)
+
+    resp_data = resp.json()
+
+    if 'encryption_info' not in resp_data or 'encrypted_content' not in resp_data:
+        return None
+
+    return resp_data['encryption_info'], base64.urlsafe_b64decode(
+        bytes(resp_data['encrypted_content'], encoding='ascii'))
+
+
+# The errors that mean a response to a resumed request can't be trusted.
+SESSION_RESPONSE_ERRORS = (ValueError,) + cipher_suites.DECRYPTION_ERRORS
+
+
+# Decrypts the response to a resumed request. Raises one of the
+# SESSION_RESPONSE_ERRORS if it was meant to be encrypted for the session
+# and the nonce sent with the request, but isn't.
+def _decrypt_session_response(session, nonce, resp):
+    if resp.status_code != 200:
+        return None
+
+    encrypted_response = _read_encrypted_response(resp)
+    if encrypted_response is None:
+        raise ValueError('response is not encrypted')
+
+    encryption_info, ciphertext = encrypted_response
+
+    if encryption_info.get('session_id') != session['session_id']:
+        raise ValueError('response is for a different session')
+
+    return str(session['cipher'].decrypt(ciphertext, bytes(nonce, encoding='ascii')),
+               encoding='ascii')
@@ -0,0 +1,37 @@
+import json
+import struct
+
+
+# Encrypted responses can be sent to blades that accept it as a binary
+# envelope instead of JSON, so that the ciphertext doesn't have to be base64
+# encoded and decoded. The envelope is the length of the encryption info, as
+# a 4 byte big-endian integer, then the encryption info as JSON, then the
+# raw ciphertext.
+MIMETYPE = 'application/vnd.labrys.envelope'
+
+
+def pack(encryption_info, ciphertext):
+    header = bytes(json.dumps(encryption_info), encoding='utf-8')
+    return b''.join([struct.pack('>I', len(header)), header, ciphertext])
+
+
+# Returns the encryption info and a memoryview of the ciphertext, or None if
+# `data` isn't an envelope.
+def unpack(data):
+    data = memoryview(data)
+    if len(data) < 4:
+        return None
+
+    header_length = struct.unpack_from('>I', data)[0]
+    if len(data) < 4 + header_length:
+        return None
+
+    try:
+        encryption_info = json.loads(bytes(data[4:4 + header_length]))
+    except ValueError:
+        return None
+
+    if not isinstance(encryption_info, dict):
+        return None
+
+    return encryption_info, data[4 + header_length:]
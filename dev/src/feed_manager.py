@@ -1,28 +1,47 @@
 import datetime
+import json
 import os
 import random
 import re
-from tinydb import TinyDB, Query
+
+import src.config as config
+import src.cursors as cursors
+import src.sorted_index as sorted_index
+import src.storage as storage
+import src.ttl_cache as ttl_cache
 
 
 class FeedManager(object):
 
-    def __init__(self, data_dir, identity_manager, permissions_manager):
+    def __init__(self, data_dir, identity_manager, permissions_manager, subscriptions_manager):
         self.data_dir = data_dir
-        self.feed_db = TinyDB(os.path.join(self.data_dir, 'feed.json'))
+        self.storage = storage.open_storage(self.data_dir)
+        self.feed_db = self.storage.table('feed')
+        self.feed_index = sorted_index.SortedIndex(
+            self.feed_db.project('id', 'publish_datetime'))
         self.feed_attachments_dir = os.path.join(
             self.data_dir, 'feed_attachments')
 
         self.identity_manager = identity_manager
         self.permissions_manager = permissions_manager
+        self.subscriptions_manager = subscriptions_manager
 
         self.max_list_items_to_display = 3
 
+        # changes whenever a message is added to or removed from the feed
+        self.feed_version = self.new_version()
+
+        # (feed version, permissions version, effective permissions,
+        # last_seen, as_object) -> the serialized messages for feed_snapshot
+        cfg = config.load_config(self.data_dir)
+        self.snapshots = ttl_cache.TTLCache(
+            cfg['feed_snapshot_cache_size'], cfg['feed_snapshot_ttl'])
+
+    def new_version(self):
+        return ''.join([random.choice('0123456789abcdef') for i in range(30)])
+
     def message_with_id(self, id):
-        messages = self.feed_db.search(Query().id == id)
-        if len(messages) == 0:
-            return None
-        return messages[0]
+        return self.feed_db.get(id=id)
 
     def message_with_id_public_authorization(self, id):
         msg = self.message_with_id(id)
@@ -38,52 +57,86 @@ class FeedManager(object):
         return self.feed_db.all()
 
     def messages_after(self, message):
-        messages = self.feed_db.search((Query().publish_datetime >= message['publish_datetime']) &
-                                       (Query().id != message['id']))
-        return messages
+        ids = [id for id in self.feed_index.ids_after((message['publish_datetime'],))
+               if id != message['id']]
+        return self.feed_db.search_in('id', ids)
+
+    # Gets every message that is newer than `last_seen`, which can be either a
+    # cursor key or the bare id of a message.
+    def messages_since(self, last_seen=None):
+        key = cursors.key_for_last_seen(last_seen, self.feed_index)
+        if key is None:
+            return self.all_messages()
+        return self.feed_db.search_in('id', self.feed_index.ids_after(key))
+
+    # Gets the messages newer than `last_seen` that a blade with the given
+    # effective permissions can view, serialized as JSON. Every blade with the
+    # same permissions that polls from the same point gets the same messages,
+    # so they're only read, filtered and serialized once, until the feed or
+    # anyone's permissions change. With `as_object`, the messages are
+    # serialized as `{"messages": [...]}` instead of a bare list.
+    def feed_snapshot(self, last_seen, effective_permissions, as_object=False):
+        key = (self.feed_version, self.permissions_manager.permissions_version,
+               effective_permissions, last_seen, as_object)
+
+        snapshot = self.snapshots.get(key)
+        if snapshot is None:
+            messages = [msg for msg in self.messages_since(last_seen)
+                        if self.permissions_manager.permitted_by(effective_permissions, msg['permissions_categories'])]
+
+            for msg in messages:
+                msg.pop('permissions_categories', None)
+
+            if as_object:
+                snapshot = json.dumps({'messages': messages})
+            else:
+                snapshot = json.dumps(messages)
+            self.snapshots.put(key, snapshot)
+
+        return snapshot
 
     def remove_message(self, id):
-        self.feed_db.remove(Query().id == id)
+        self.feed_db.remove(id=id)
+        self.feed_index.remove(id)
+        self.feed_version = self.new_version()
+        self.snapshots.clear()
 
     def feed(self, last_seen=None):
-        if last_seen is None:
-            messages = self.feed_db.search(Query().type == 'post')
-        else:
-            found = self.feed_db.search(Query().id == last_seen)
-            found.sort(reverse=True, key=lambda m: m['publish_datetime'])
-            print('FOUND: ', found)
-            if found:
-                messages = self.feed_db.search((Query().type == 'post') &
-                                               (Query().publish_datetime <= found[0]['publish_datetime']) &
-                                               (Query().id != last_seen))
-            else:
-                messages = self.feed_db.search(Query().type == 'post')
+        return self.feed_page(last_seen)
 
-        messages.sort(reverse=True, key=lambda m: m['publish_datetime'])
+    # Gets the posts that come after `last_seen` in the feed, newest first,
+    # stopping once `count` posts that satisfy `predicate` have been found.
+    def feed_page(self, last_seen=None, count=None, predicate=lambda msg: True):
+        key = cursors.key_for_last_seen(last_seen, self.feed_index)
 
-        return messages
+        return self.feed_index.page(self.feed_db, key, count,
+                                    lambda msg: msg['type'] == 'post' and predicate(msg))
 
     def feed_owner_authorization(self, last_seen=None):
-        messages = self.feed(last_seen)
+        messages = self.feed_page(
+            last_seen, self.max_list_items_to_display + 1)
 
         if len(messages) <= self.max_list_items_to_display:
             next_last_seen = None
         else:
-            next_last_seen = messages[self.max_list_items_to_display - 1]['id']
+            next_last_seen = cursors.cursor_for(
+                messages[self.max_list_items_to_display - 1])
 
         messages = messages[:self.max_list_items_to_display]
 
         return messages, next_last_seen
 
     def feed_public_authorization(self, last_seen=None):
-        messages = self.feed(last_seen)
-        messages = [msg for msg in messages if self.permissions_manager.permitted_to_view_message(
-            None, msg['permissions_categories'])]
+        messages = self.feed_page(
+            last_seen,
+            self.max_list_items_to_display + 1,
+            lambda msg: self.permissions_manager.permitted_to_view_message(None, msg['permissions_categories']))
 
         if len(messages) <= self.max_list_items_to_display:
             next_last_seen = None
         else:
-            next_last_seen = messages[self.max_list_items_to_display - 1]['id']
+            next_last_seen = cursors.cursor_for(
+                messages[self.max_list_items_to_display - 1])
 
         messages = messages[:self.max_list_items_to_display]
 
@@ -125,5 +178,10 @@ class FeedManager(object):
                 })
 
         self.feed_db.insert(message)
+        self.feed_index.add(message)
+        self.feed_version = self.new_version()
+        self.snapshots.clear()
+
+        self.subscriptions_manager.notify_subscribers('new_feed_messages')
 
         return message['id']
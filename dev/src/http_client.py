@@ -0,0 +1,90 @@
+import threading
+import time
+import urllib.parse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import src.config as config
+import src.peer_health as peer_health
+
+
+# The HTTPClient is used for all of a blade's requests to other blades. It
+# keeps a pool of keep-alive connections to each blade, so that requests to a
+# blade can reuse a connection, and the circuit behind it when the blade is an
+# onion service, instead of setting up a new one every time. Every request
+# gets a timeout, and idempotent requests are retried when a blade can't be
+# reached or is briefly unavailable. Requests to a blade that has stopped
+# responding fail straight away, until it is found to be back.
+class HTTPClient(object):
+
+    def __init__(self, data_dir):
+        cfg = config.load_config(data_dir)
+        self.timeout = (cfg['http_connect_timeout'], cfg['http_read_timeout'])
+
+        retry = Retry(total=cfg['http_retries'],
+                      backoff_factor=cfg['http_retry_backoff'],
+                      status_forcelist=[502, 503, 504],
+                      raise_on_status=False)
+        self.adapter = HTTPAdapter(pool_connections=cfg['http_pool_connections'],
+                                   pool_maxsize=cfg['http_pool_maxsize'],
+                                   max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('http://', self.adapter)
+        self.session.mount('https://', self.adapter)
+
+        self.peer_health = peer_health.PeerHealth(data_dir)
+
+        self.lock = threading.Lock()
+        self.requests_sent = 0
+
+    def request(self, method, url, **kwargs):
+        host = urllib.parse.urlsplit(url).netloc
+        self.peer_health.check(host)
+
+        kwargs.setdefault('timeout', self.timeout)
+        with self.lock:
+            self.requests_sent += 1
+
+        start = time.monotonic()
+        try:
+            resp = self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.peer_health.record_failure(host)
+            raise
+
+        if resp.status_code >= 500:
+            self.peer_health.record_failure(host)
+        else:
+            self.peer_health.record_success(host, time.monotonic() - start)
+
+        return resp
+
+    def get(self, url, params=None, **kwargs):
+        return self.request('GET', url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    # Counts the requests attempted, retries included, and the connections
+    # opened by the pools that are currently open. Every attempt beyond the
+    # first on a connection reused it.
+    def stats(self):
+        pools = self.adapter.poolmanager.pools
+        attempts = 0
+        connections_opened = 0
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                attempts += pool.num_requests
+                connections_opened += pool.num_connections
+
+        return {
+            'requests_sent': self.requests_sent,
+            'open_pools': len(pools),
+            'requests_attempted': attempts,
+            'connections_opened': connections_opened,
+            'connections_reused': max(0, attempts - connections_opened),
+        }
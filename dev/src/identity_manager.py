@@ -1,5 +1,12 @@
+import base64
+import hashlib
+import json
 import os
 import re
+import threading
+
+import nacl.encoding
+import nacl.signing
 
 import src.passwords as passwords
 
@@ -23,11 +30,50 @@ class IdentityManager(object):
         self.session_secret_key_file = os.path.join(
             self.secrets_dir, 'session_secret_key.txt')
 
+        # path -> ((mtime_ns, size), contents), so that identity files are
+        # only read again once they've changed on disk
+        self.file_cache = {}
+        self.avatar_cache = (None, None)
+        self.avatar_hash_cache = (None, None)
+
+        # (private signing key, SigningKey), so that the key is only parsed
+        # again once the private signing key file has changed
+        self.signing_key_cache = (None, None)
+        self.cache_lock = threading.Lock()
+
+    # Reads a file, or returns what was read last time if its modification
+    # time and size haven't changed since, which costs a stat instead of an
+    # open and a read.
+    def _read_file(self, path):
+        st = os.stat(path)
+        version = (st.st_mtime_ns, st.st_size)
+
+        with self.cache_lock:
+            cached = self.file_cache.get(path)
+            if cached is not None and cached[0] == version:
+                return cached[1]
+
+        with open(path, 'r') as f:
+            contents = f.read()
+
+        with self.cache_lock:
+            self.file_cache[path] = (version, contents)
+
+        return contents
+
     def blade_url(self):
-        with open(self.blade_url_file, 'r') as f:
-            return f.read().strip()
+        return self._read_file(self.blade_url_file).strip()
 
+    # The avatar is found by listing the identity directory, which only needs
+    # doing again when the directory's modification time changes, i.e. when a
+    # file has been added to it, removed from it or renamed in it.
     def avatar_file_name(self):
+        dir_mtime = os.stat(self.identity_dir).st_mtime_ns
+
+        with self.cache_lock:
+            if self.avatar_cache[0] == dir_mtime:
+                return self.avatar_cache[1]
+
         avatar_candidates =\
             [f for f in os.listdir(self.identity_dir)
              if re.search('^avatar\.(png|PNG|jpg|JPG|jpeg|JPEG|gif|GIF|svg|SVG)$', f)]
@@ -37,35 +83,87 @@ class IdentityManager(object):
         else:
             avatar_file_name = None
 
+        with self.cache_lock:
+            self.avatar_cache = (dir_mtime, avatar_file_name)
+
         return avatar_file_name
 
+    # A hash of the avatar's contents, so that other blades can tell whether
+    # the avatar they have is still current without downloading it again.
+    def avatar_hash(self):
+        avatar_file_name = self.avatar_file_name()
+        if avatar_file_name is None:
+            return None
+
+        path = os.path.join(self.identity_dir, avatar_file_name)
+        st = os.stat(path)
+        version = (path, st.st_mtime_ns, st.st_size)
+
+        with self.cache_lock:
+            if self.avatar_hash_cache[0] == version:
+                return self.avatar_hash_cache[1]
+
+        h = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(64 * 1024), b''):
+                h.update(chunk)
+        avatar_hash = h.hexdigest()
+
+        with self.cache_lock:
+            self.avatar_hash_cache = (version, avatar_hash)
+
+        return avatar_hash
+
+    # Everything other blades need to know about this blade's identity, with
+    # a version that changes whenever any of it does.
+    def identity_bundle(self):
+        bundle = {
+            'public_signing_key': self.public_signing_key(),
+            'display_name': self.display_name(),
+            'bio': self.bio(),
+            'avatar_hash': self.avatar_hash()
+        }
+        bundle['version'] = hashlib.sha256(json.dumps(
+            bundle, sort_keys=True).encode('utf8')).hexdigest()
+        return bundle
+
     def display_name(self):
-        with open(self.display_name_file, 'r') as f:
-            return f.read()
+        return self._read_file(self.display_name_file)
 
     def bio(self):
-        with open(self.bio_file, 'r') as f:
-            return f.read()
+        return self._read_file(self.bio_file)
 
     def unsafe_private_signing_key(self):
-        with open(self.private_signing_key_file, 'r') as f:
-            return f.read()
+        return self._read_file(self.private_signing_key_file)
 
     def public_signing_key(self):
-        with open(self.public_signing_key_file, 'r') as f:
-            return f.read()
+        return self._read_file(self.public_signing_key_file)
 
     def unsafe_session_secret_key(self):
-        with open(self.session_secret_key_file, 'r') as f:
-            return f.read().strip()
+        return self._read_file(self.session_secret_key_file).strip()
+
+    def signing_key(self):
+        private_signing_key = self._read_file(self.private_signing_key_file)
+
+        with self.cache_lock:
+            if self.signing_key_cache[0] == private_signing_key:
+                return self.signing_key_cache[1]
+
+        signing_key = nacl.signing.SigningKey(private_signing_key.encode(
+            encoding='ascii'), encoder=nacl.encoding.Base64Encoder)
+
+        with self.cache_lock:
+            self.signing_key_cache = (private_signing_key, signing_key)
+
+        return signing_key
+
+    def verify_key(self):
+        return self.signing_key().verify_key
 
     def sign(self, message):
-        with open(self.private_signing_key_file, 'r') as f:
-            signing_key = nacl.signing.SigningKey(f.read().encode(
-                encoding='ascii'), encoder=nacl.encoding.Base64Encoder)
-            signed = signing_key.sign(message.encode(encoding='ascii'))
-            return base64.b64encode(signed.signature)
+        signed = self.signing_key().sign(message.encode(encoding='ascii'))
+        return base64.b64encode(signed.signature)
 
     def check_password(self, submitted_password):
-        with open(self.password_hash_file, 'r') as f:
-            return passwords.check_password(submitted_password, f.read())
+        return passwords.check_password(submitted_password,
+                                        self._read_file(self.password_hash_file))
@@ -1,87 +1,258 @@
+import concurrent.futures
+import datetime
+import hashlib
 import os
 import requests
 
-from tinydb import TinyDB, Query
-
+import src.config as config
 import src.public_keys as public_keys
+import src.storage as storage
+
+
+# The file extensions for the kinds of avatar a blade can have.
+AVATAR_EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/gif': 'gif',
+    'image/svg+xml': 'svg',
+}
+
+# The errors a blade can cause by sending back something that isn't an
+# identity bundle, such as malformed JSON or a bundle missing fields.
+MALFORMED_IDENTITY_ERRORS = (ValueError, KeyError, TypeError)
+
+# The fields of a known blade record that describe its downloaded avatar.
+AVATAR_FIELDS = ['avatar_filename', 'avatar_etag',
+                 'avatar_last_modified', 'avatar_checked_datetime']
 
 
 class KnownBladesManager(object):
 
-    def __init__(self, data_dir):
+    def __init__(self, data_dir, http_client):
         self.data_dir = data_dir
-        self.known_blades_db = TinyDB(
-            os.path.join(self.data_dir, 'known_blades.json'))
+        self.http_client = http_client
+        self.storage = storage.open_storage(self.data_dir)
+        self.known_blades_db = self.storage.table('known_blades')
         self.known_blades_avatars_dir = os.path.join(
             self.data_dir, 'known_blades_avatars')
 
+        cfg = config.load_config(self.data_dir)
+        self.avatar_ttl = cfg['avatar_ttl']
+
     def all_known_blades(self):
         return self.known_blades_db.all()
 
+    # Loads the identity of the blade at `blade_url`, or, if it hasn't changed
+    # since we last loaded it, gets the identity we have for it. If the blade
+    # can't be reached, or sends back something that isn't an identity, the
+    # identity we last had for that url is used instead.
+    #
+    # The whole identity is loaded in one request from /api/identity. Blades
+    # from before that endpoint existed are loaded from the separate identity
+    # endpoints instead.
     def load_and_cache_blade_identity(self, blade_url):
-        blade_identity = {'url': blade_url}
+        cached = self.known_blades_db.get(url=blade_url)
+
+        headers = {}
+        if cached and cached.get('identity_version'):
+            headers['If-None-Match'] = '"' + cached['identity_version'] + '"'
 
         try:
-            resp = requests.get('http://' + blade_url +
-                                '/api/identity/public_signing_key')
-        except requests.exceptions.ConnectionError:
-            return None
+            resp = self.http_client.get('http://' + blade_url + '/api/identity',
+                                        headers=headers)
+
+            if resp.status_code == 304:
+                return cached
+            elif resp.status_code == 404:
+                return self.load_and_cache_legacy_blade_identity(blade_url)
+            elif resp.status_code != 200:
+                return None
+
+            bundle = resp.json()
+
+            previous = self.known_blades_db.get(
+                public_signing_key=bundle['public_signing_key'])
+
+            # The bundle isn't signed, so any blade could claim to have some
+            # other blade's key. A blade we already know is only updated from
+            # the url we know it at.
+            if previous and previous['url'] != blade_url:
+                return previous
 
+            if previous and previous.get('identity_version') == bundle['version']:
+                return previous
+
+            blade_identity = {
+                'url': blade_url,
+                'public_signing_key': bundle['public_signing_key'],
+                'display_name': bundle['display_name'],
+                'bio': bundle['bio'],
+                'avatar_hash': bundle['avatar_hash'],
+                'identity_version': bundle['version']
+            }
+
+            # the avatar is only downloaded again if it has changed
+            if bundle['avatar_hash'] is not None and not (previous and previous.get('avatar_hash') == bundle['avatar_hash']):
+                blade_identity.update(self.fetch_avatar(
+                    blade_url, bundle['public_signing_key'], previous))
+
+        except requests.exceptions.RequestException:
+            return cached
+        except MALFORMED_IDENTITY_ERRORS as e:
+            print('MALFORMED IDENTITY FROM BLADE', blade_url, repr(e))
+            return cached
+
+        # A blade that has removed its avatar has the old one forgotten. An
+        # update can't remove fields, so the record is replaced instead.
+        if previous and blade_identity['avatar_hash'] is None and any(field in previous for field in AVATAR_FIELDS):
+            self.remove_avatar_file(previous)
+
+            blade_identity = {**{k: v for k, v in previous.items() if k not in AVATAR_FIELDS},
+                              **blade_identity}
+            with self.storage.batch():
+                self.known_blades_db.remove(
+                    public_signing_key=blade_identity['public_signing_key'])
+                self.known_blades_db.insert(blade_identity)
+            return blade_identity
+
+        if previous:
+            self.known_blades_db.update(blade_identity,
+                                        public_signing_key=blade_identity['public_signing_key'])
+            return {**previous, **blade_identity}
+
+        self.known_blades_db.insert(blade_identity)
+
+        return blade_identity
+
+    # Loads a blade's identity from the separate identity endpoints. The
+    # public signing key is loaded first, since if it's a blade we know
+    # already nothing else is needed, and the rest is loaded concurrently.
+    def load_and_cache_legacy_blade_identity(self, blade_url):
+        blade_identity = {'url': blade_url}
+
+        resp = self.http_client.get('http://' + blade_url +
+                                    '/api/identity/public_signing_key')
         if resp.status_code != 200:
             return None
 
         blade_identity['public_signing_key'] = resp.text
 
-        previous = self.known_blades_db.search(
-            Query().public_signing_key == blade_identity['public_signing_key'])
+        previous = self.known_blades_db.get(
+            public_signing_key=blade_identity['public_signing_key'])
         if previous:
-            return previous[0]
-
-        resp = requests.get('http://' + blade_url +
-                            '/api/identity/display_name')
-        if resp.status_code == 200:
-            blade_identity['display_name'] = resp.text
-
-        resp = requests.get('http://' + blade_url + '/api/identity/bio')
-        if resp.status_code == 200:
-            blade_identity['bio'] = resp.text
-
-        resp = requests.get('http://' + blade_url + '/api/identity/avatar')
-        if resp.status_code == 200:
-            ct = resp.headers['Content-Type']
-            if ct == 'image/jpeg':
-                ext = 'jpg'
-            elif ct == 'image/gif':
-                ext = 'gif'
-            elif 'image/svg+xml' in ct:
-                ext = 'svg'
-            else:
-                ext = None
-
-            if ext:
-                blade_identity['avatar_filename'] = public_keys.encode_public_key(
-                    blade_identity['public_signing_key']) + '.' + ext
-                with open(os.path.join(self.known_blades_avatars_dir, blade_identity['avatar_filename']), 'wb') as fd:
-                    for chunk in resp.iter_content(chunk_size=128):
-                        fd.write(chunk)
+            return previous
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+            display_name = executor.submit(
+                self.http_client.get, 'http://' + blade_url + '/api/identity/display_name')
+            bio = executor.submit(
+                self.http_client.get, 'http://' + blade_url + '/api/identity/bio')
+            avatar_fields = executor.submit(
+                self.fetch_avatar, blade_url, blade_identity['public_signing_key'])
+
+        if display_name.result().status_code == 200:
+            blade_identity['display_name'] = display_name.result().text
+
+        if bio.result().status_code == 200:
+            blade_identity['bio'] = bio.result().text
+
+        blade_identity.update(avatar_fields.result())
 
         self.known_blades_db.insert(blade_identity)
 
         return blade_identity
 
-    def cached_blade_identity(self, public_signing_key):
-        previous = self.known_blades_db.search(
-            Query().public_signing_key == public_signing_key)
+    # Downloads a blade's avatar, and returns the fields of its known blade
+    # record to update. If `known` is the blade's known blade record, the
+    # avatar is only downloaded if it has changed since it was last
+    # downloaded.
+    def fetch_avatar(self, blade_url, public_signing_key, known=None):
+        headers = {}
+        if known and known.get('avatar_etag'):
+            headers['If-None-Match'] = known['avatar_etag']
+        if known and known.get('avatar_last_modified'):
+            headers['If-Modified-Since'] = known['avatar_last_modified']
 
-        if previous:
-            return previous[0]
-        else:
-            return None
+        fields = {
+            'avatar_checked_datetime': datetime.datetime.utcnow().isoformat()}
+
+        with self.http_client.get('http://' + blade_url + '/api/identity/avatar',
+                                  headers=headers, stream=True) as resp:
+            if resp.status_code != 200:
+                return fields
+
+            ext = AVATAR_EXTENSIONS.get(
+                resp.headers.get('Content-Type', '').split(';')[0].strip())
+            if ext is None:
+                return fields
+
+            avatar_filename = public_keys.encode_public_key(
+                public_signing_key) + '.' + ext
+            path = os.path.join(self.known_blades_avatars_dir, avatar_filename)
+
+            # The avatar is written to a temporary file first, so that the old
+            # avatar can still be served until the new one is complete.
+            h = hashlib.sha256()
+            with open(path + '.tmp', 'wb') as fd:
+                for chunk in resp.iter_content(chunk_size=64 * 1024):
+                    fd.write(chunk)
+                    h.update(chunk)
+            os.replace(path + '.tmp', path)
+
+        if known and known.get('avatar_filename') not in (None, avatar_filename):
+            self.remove_avatar_file(known)
+
+        fields['avatar_filename'] = avatar_filename
+        fields['avatar_hash'] = h.hexdigest()
+        fields['avatar_etag'] = resp.headers.get('ETag')
+        fields['avatar_last_modified'] = resp.headers.get('Last-Modified')
+
+        return fields
+
+    def remove_avatar_file(self, known):
+        if not known.get('avatar_filename'):
+            return
+
+        try:
+            os.remove(os.path.join(
+                self.known_blades_avatars_dir, known['avatar_filename']))
+        except OSError:
+            pass
+
+    # Checks whether the avatars of known blades that haven't been checked in
+    # the last `avatar_ttl` seconds have changed. Each blade's identity is
+    # loaded again, which costs a 304 if nothing has changed, and its avatar
+    # is only downloaded if the identity has a different avatar hash. Blades
+    # from before identity bundles have their avatars revalidated directly.
+    def revalidate_avatars(self):
+        now = datetime.datetime.utcnow()
+        cutoff = (now - datetime.timedelta(seconds=self.avatar_ttl)).isoformat()
+
+        for blade_identity in self.known_blades_db.all():
+            if blade_identity.get('avatar_checked_datetime', '') > cutoff:
+                continue
+
+            fields = {'avatar_checked_datetime': now.isoformat()}
+            try:
+                if blade_identity.get('identity_version') is not None:
+                    self.load_and_cache_blade_identity(blade_identity['url'])
+                elif 'avatar_filename' in blade_identity:
+                    fields = self.fetch_avatar(blade_identity['url'],
+                                               blade_identity['public_signing_key'],
+                                               blade_identity)
+            except requests.exceptions.RequestException:
+                continue
+
+            self.known_blades_db.update(
+                fields, public_signing_key=blade_identity['public_signing_key'])
+
+    def cached_blade_identity(self, public_signing_key):
+        return self.known_blades_db.get(public_signing_key=public_signing_key)
 
     def blade(self, blade_url):
         blade_id = self.blade_identity(blade_url)
 
-        response = requests.get('http://' + blade_url + '/api/feed')
+        response = self.http_client.get('http://' + blade_url + '/api/feed')
         if response.status_code == 200:
             messages = response.json().get('messages')
         else:
@@ -89,9 +260,9 @@ class KnownBladesManager(object):
 
         messages.sort(reverse=True, key=lambda m: m['publish_datetime'])
 
-        found = self.subscriptions_db.search(Query().url == blade_url)
-        if len(found) != 0:
-            subscription_id = found[0]['id']
+        found = self.subscriptions_db.get(url=blade_url)
+        if found:
+            subscription_id = found['id']
         else:
             subscription_id = None
 
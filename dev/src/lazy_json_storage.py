@@ -0,0 +1,362 @@
+import contextlib
+import json
+import mmap
+import os
+import re
+import threading
+
+
+# Matches the tokens that give a JSON document its structure: strings, which
+# are skipped over whole so that brackets inside them are never mistaken for
+# real ones, and brackets.
+_TOKENS = re.compile(rb'"(?:[^"\\]|\\.)*"|[{}\[\]]')
+
+
+# The lazy JSON backend reads the same TinyDB files as the JSON backend, but
+# never parses a whole file. When a table is opened, the file is scanned once
+# to find where each record starts and ends, and after that records are only
+# decoded when they're needed. Inserts are written in place at the end of the
+# file, so only updates and removes rewrite it, and even they just copy the
+# unchanged records across without decoding them.
+#
+# Only TinyDB's default table is used, since that's the only one blades have
+# ever stored records in.
+#
+# Before a table is first written inside a batch, a hard link to its file is
+# kept along with where its records were, so that if the batch fails the
+# table can be put back the way it was. Like with the JSON backend, a crash
+# part way through a batch can still leave some of it written.
+class LazyJSONTable(object):
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.lock = storage.lock
+
+        # doc_id -> (start, end) byte offsets of the record in the file, and
+        # record id -> doc_ids
+        self.offsets = {}
+        self.doc_ids_by_id = {}
+        self.next_doc_id = 1
+
+        # records inserted inside a batch, which are written when it ends or
+        # before the table is next read
+        self.pending = []
+
+        # the state of the table before the current batch first wrote to it
+        self.saved = None
+
+        # a backup left behind by a crash part way through a batch
+        if os.path.exists(self.path + '.bak'):
+            os.remove(self.path + '.bak')
+
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            with open(self.path, 'wb') as f:
+                f.write(b'{"_default": {}}')
+
+        self.file = open(self.path, 'r+b')
+        self._scan()
+
+    def _scan(self):
+        self.offsets = {}
+        self.doc_ids_by_id = {}
+        self.table_start = None
+        self.table_end = None
+
+        with mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            depth = 0
+            key = None
+            start = None
+            for token in _TOKENS.finditer(buf):
+                t = token.group()
+                if t in (b'{', b'['):
+                    if depth == 1 and key == '_default':
+                        self.table_start = token.end()
+                    elif depth == 2 and self.table_start is not None and self.table_end is None:
+                        start = token.start()
+                    depth += 1
+                elif t in (b'}', b']'):
+                    depth -= 1
+                    if depth == 2 and start is not None:
+                        self.offsets[int(key)] = (start, token.end())
+                        start = None
+                    elif depth == 1 and self.table_start is not None and self.table_end is None:
+                        self.table_end = token.start()
+                elif depth in (1, 2):
+                    key = json.loads(t)
+
+            self.file_tail = buf[self.table_end:] if self.table_end is not None else None
+
+        if self.table_start is None:
+            # a file without a default table gets one
+            self._rewrite({})
+            return
+
+        for doc_id in self.offsets:
+            self.next_doc_id = max(self.next_doc_id, doc_id + 1)
+            self._index(doc_id, self._read(doc_id))
+
+    def _index(self, doc_id, doc):
+        self.doc_ids_by_id.setdefault(doc.get('id'), set()).add(doc_id)
+
+    def _read(self, doc_id):
+        start, end = self.offsets[doc_id]
+        return json.loads(os.pread(self.file.fileno(), end - start, start))
+
+    def _docs(self, doc_ids=None):
+        if doc_ids is None:
+            doc_ids = sorted(self.offsets)
+        for doc_id in doc_ids:
+            yield doc_id, self._read(doc_id)
+
+    def _matches(self, doc, where_fields):
+        return all(doc.get(k) == v for k, v in where_fields.items())
+
+    def _find(self, where_fields):
+        if 'id' in where_fields:
+            doc_ids = sorted(self.doc_ids_by_id.get(where_fields['id'], ()))
+        else:
+            doc_ids = None
+        return [(doc_id, doc) for doc_id, doc in self._docs(doc_ids)
+                if self._matches(doc, where_fields)]
+
+    def all(self):
+        with self.lock:
+            self.flush()
+            return [doc for _, doc in self._docs()]
+
+    # Reads just the given fields of every record. Records are decoded one
+    # at a time, so this only needs memory for the fields.
+    def project(self, *fields):
+        with self.lock:
+            self.flush()
+            return [{field: doc.get(field) for field in fields}
+                    for _, doc in self._docs()]
+
+    def search(self, **where_fields):
+        with self.lock:
+            self.flush()
+            return [doc for _, doc in self._find(where_fields)]
+
+    def search_in(self, field, values):
+        values = set(values)
+        with self.lock:
+            self.flush()
+            if field == 'id':
+                doc_ids = sorted(doc_id for id in values
+                                 for doc_id in self.doc_ids_by_id.get(id, ()))
+                return [doc for _, doc in self._docs(doc_ids)]
+            return [doc for _, doc in self._docs() if doc.get(field) in values]
+
+    def get(self, **where_fields):
+        found = self.search(**where_fields)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def insert(self, doc):
+        self.insert_multiple([doc])
+
+    def insert_multiple(self, docs):
+        with self.lock:
+            self._write()
+            self.pending += [dict(doc) for doc in docs]
+            if self.storage.batch_depth == 0:
+                self.storage.flush()
+
+    def update(self, fields, **where_fields):
+        with self.lock:
+            self._write()
+            self.flush()
+            changed = {}
+            for doc_id, doc in self._find(where_fields):
+                changed[doc_id] = {**doc, **fields}
+            if changed:
+                self._rewrite(changed)
+
+    def remove(self, **where_fields):
+        with self.lock:
+            self._write()
+            self.flush()
+            removed = {doc_id: None for doc_id, _ in self._find(where_fields)}
+            if removed:
+                self._rewrite(removed)
+
+    def remove_in(self, field, values):
+        values = set(values)
+        with self.lock:
+            self._write()
+            self.flush()
+            if field == 'id':
+                doc_ids = [doc_id for id in values
+                           for doc_id in self.doc_ids_by_id.get(id, ())]
+            else:
+                doc_ids = [doc_id for doc_id, doc in self._docs()
+                           if doc.get(field) in values]
+            if doc_ids:
+                self._rewrite({doc_id: None for doc_id in doc_ids})
+
+    def __len__(self):
+        return len(self.offsets) + len(self.pending)
+
+    # Appends the pending records in place, by writing them over the end of
+    # the default table and putting the rest of the file back after them.
+    def flush(self):
+        if not self.pending:
+            return
+
+        pos = self.table_end
+        data = b''
+        for doc in self.pending:
+            doc_id = self.next_doc_id
+            self.next_doc_id += 1
+
+            if self.offsets or data:
+                data += b', '
+            data += bytes(json.dumps(str(doc_id)), encoding='utf8') + b': '
+            encoded = bytes(json.dumps(doc), encoding='utf8')
+            self.offsets[doc_id] = (pos + len(data),
+                                    pos + len(data) + len(encoded))
+            data += encoded
+            self._index(doc_id, doc)
+
+        self.pending = []
+        self.file.seek(pos)
+        self.file.write(data + self.file_tail)
+        self.file.truncate()
+        self.file.flush()
+        self.table_end = pos + len(data)
+
+    # Notes that the table is being written to, saving its state first if
+    # this is the first write inside a batch.
+    def _write(self):
+        self.storage.written_tables.add(self)
+
+        if self.storage.batch_depth == 0 or self.saved is not None:
+            return
+
+        os.link(self.path, self.path + '.bak')
+        self.saved = (dict(self.offsets),
+                      {id: set(doc_ids)
+                       for id, doc_ids in self.doc_ids_by_id.items()},
+                      self.next_doc_id,
+                      self.table_start,
+                      self.table_end,
+                      self.file_tail)
+
+    # Writes the pending records, and forgets the state saved for the batch.
+    def commit(self):
+        self.flush()
+
+        if self.saved is not None:
+            os.remove(self.path + '.bak')
+            self.saved = None
+
+    # Throws away every write made in the current batch. Updates and removes
+    # replace the file, so the saved link still has the file as it was,
+    # except for records appended in place after the old end of the table,
+    # which are cut off again.
+    def discard(self):
+        self.pending = []
+
+        if self.saved is None:
+            return
+
+        (self.offsets, self.doc_ids_by_id, self.next_doc_id,
+         self.table_start, self.table_end, self.file_tail) = self.saved
+        self.saved = None
+
+        os.replace(self.path + '.bak', self.path)
+        self.file.close()
+        self.file = open(self.path, 'r+b')
+        self.file.seek(self.table_end)
+        self.file.write(self.file_tail)
+        self.file.truncate()
+        self.file.flush()
+
+    # Writes the file out again with the records in `changed` replaced, or
+    # removed if they map to None. Unchanged records are copied across as
+    # they are.
+    def _rewrite(self, changed):
+        tmp_path = self.path + '.tmp'
+        offsets = {}
+        doc_ids_by_id = {}
+
+        with open(tmp_path, 'wb') as out:
+            out.write(b'{"_default": {')
+            first = True
+            for doc_id in sorted(set(self.offsets) | set(changed)):
+                if doc_id in changed:
+                    doc = changed[doc_id]
+                    if doc is None:
+                        continue
+                    encoded = bytes(json.dumps(doc), encoding='utf8')
+                else:
+                    start, end = self.offsets[doc_id]
+                    encoded = os.pread(self.file.fileno(), end - start, start)
+                    doc = json.loads(encoded)
+
+                if not first:
+                    out.write(b', ')
+                first = False
+                out.write(bytes(json.dumps(str(doc_id)),
+                                encoding='utf8') + b': ')
+                offsets[doc_id] = (out.tell(), out.tell() + len(encoded))
+                out.write(encoded)
+                doc_ids_by_id.setdefault(doc.get('id'), set()).add(doc_id)
+
+            table_end = out.tell()
+            out.write(b'}}')
+
+        os.replace(tmp_path, self.path)
+        self.file.close()
+        self.file = open(self.path, 'r+b')
+        self.offsets = offsets
+        self.doc_ids_by_id = doc_ids_by_id
+        self.table_start = len(b'{"_default": {')
+        self.table_end = table_end
+        self.file_tail = b'}}'
+
+
+class LazyJSONStorage(object):
+
+    def __init__(self, data_dir, table_files):
+        self.data_dir = data_dir
+        self.table_files = table_files
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.written_tables = set()
+        self.tables = {}
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = LazyJSONTable(
+                    self, os.path.join(self.data_dir, self.table_files[name]))
+            return self.tables[name]
+
+    def flush(self):
+        for table in self.written_tables:
+            table.commit()
+        self.written_tables = set()
+
+    # Records inserted inside a batch are appended together when it ends, or
+    # when the table is read, and every write made inside it is undone if it
+    # fails.
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield
+            except:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    for table in self.written_tables:
+                        table.discard()
+                    self.written_tables = set()
+                raise
+            else:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.flush()
@@ -0,0 +1,345 @@
+import contextlib
+import json
+import os
+import re
+import threading
+
+import src.config as config
+
+
+# The log backend stores each table as a directory of append-only segment
+# files. Every insert or update appends one line holding the whole record,
+# and every remove appends a tombstone, so the cost of a write doesn't depend
+# on how big the table is. The records are replayed into memory at startup,
+# and a background thread compacts the sealed segments to reclaim the space
+# used by old versions of records.
+class LogTable(object):
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+        self.dir = os.path.join(storage.log_dir, name)
+        self.lock = storage.lock
+        self.compaction_lock = threading.Lock()
+
+        # doc_id -> record, doc_id -> number of the segment holding the latest
+        # version of the record, and record id -> doc_ids
+        self.docs = {}
+        self.locations = {}
+        self.doc_ids_by_id = {}
+        self.next_doc_id = 1
+
+        # entries appended inside a batch, which are written when it ends,
+        # and the records as they were before the batch, so that it can be
+        # undone if it fails
+        self.pending = []
+        self.saved = None
+
+        os.makedirs(self.dir, exist_ok=True)
+        self._replay()
+
+    def _segment_path(self, number):
+        return os.path.join(self.dir, '%08d.log' % number)
+
+    def _segment_numbers(self):
+        return sorted(int(f[:-len('.log')]) for f in os.listdir(self.dir)
+                      if re.match('^[0-9]+\\.log$', f))
+
+    def _replay(self):
+        # a compacted segment that was still being written is only left over
+        # from an interrupted compaction
+        for f in os.listdir(self.dir):
+            if re.match('^[0-9]+\\.log\\.tmp$', f):
+                os.remove(os.path.join(self.dir, f))
+
+        numbers = self._segment_numbers()
+
+        # A compacted segment holds every live record from the segments
+        # before it, so those are only left over from an interrupted
+        # compaction and can be removed.
+        for number in reversed(numbers):
+            if self._is_compacted(number):
+                for older in numbers[:numbers.index(number)]:
+                    os.remove(self._segment_path(older))
+                numbers = numbers[numbers.index(number):]
+                break
+
+        for number in numbers:
+            with open(self._segment_path(number), 'rb') as f:
+                good_length = 0
+                for line in f:
+                    # a line without a newline is a write that was cut short
+                    if not line.endswith(b'\n'):
+                        break
+                    good_length += len(line)
+                    self._apply(json.loads(line), number)
+
+            if os.path.getsize(self._segment_path(number)) != good_length:
+                with open(self._segment_path(number), 'r+b') as f:
+                    f.truncate(good_length)
+
+        if numbers:
+            self.active_number = numbers[-1]
+        else:
+            self.active_number = 1
+        self.active_file = open(self._segment_path(self.active_number), 'ab')
+
+    def _is_compacted(self, number):
+        with open(self._segment_path(number), 'rb') as f:
+            first_line = f.readline()
+        return first_line.endswith(b'\n') and json.loads(first_line).get('compacted', False)
+
+    def _apply(self, entry, number):
+        if 'doc_id' not in entry:
+            return
+
+        doc_id = entry['doc_id']
+        self.next_doc_id = max(self.next_doc_id, doc_id + 1)
+
+        old = self.docs.pop(doc_id, None)
+        if old is not None:
+            self.locations.pop(doc_id)
+            self.doc_ids_by_id.get(old.get('id'), set()).discard(doc_id)
+
+        if not entry.get('deleted'):
+            self.docs[doc_id] = entry['doc']
+            self.locations[doc_id] = number
+            self.doc_ids_by_id.setdefault(
+                entry['doc'].get('id'), set()).add(doc_id)
+
+    def _append(self, entries):
+        with self.lock:
+            if self.storage.batch_depth > 0 and self.saved is None:
+                self.saved = (dict(self.docs),
+                              dict(self.locations),
+                              {id: set(doc_ids) for id, doc_ids in self.doc_ids_by_id.items()},
+                              self.next_doc_id)
+
+            for entry in entries:
+                self._apply(entry, self.active_number)
+
+            self.pending += entries
+            self.storage.written_tables.add(self)
+            if self.storage.batch_depth == 0:
+                self.storage.flush()
+
+    # Writes the pending entries with a single write, so that a whole batch
+    # costs one write and one fsync per table.
+    def flush(self):
+        self.saved = None
+        if not self.pending:
+            return
+
+        data = b''.join(bytes(json.dumps(entry), encoding='utf8') + b'\n'
+                        for entry in self.pending)
+        self.pending = []
+        self.active_file.write(data)
+        self.active_file.flush()
+        if self.storage.fsync:
+            os.fsync(self.active_file.fileno())
+
+        if self.active_file.tell() >= self.storage.segment_size:
+            self._roll()
+
+    # Throws away the entries that haven't been written yet, and puts the
+    # records back the way they were before the batch.
+    def discard(self):
+        self.pending = []
+        if self.saved is not None:
+            self.docs, self.locations, self.doc_ids_by_id, self.next_doc_id = self.saved
+            self.saved = None
+
+    def _roll(self):
+        self.active_file.close()
+        self.active_number += 1
+        self.active_file = open(self._segment_path(self.active_number), 'ab')
+        self.storage.compaction_wanted.set()
+
+    def compact(self):
+        with self.compaction_lock:
+            self._compact()
+
+    def _compact(self):
+        with self.lock:
+            sealed = [n for n in self._segment_numbers()
+                      if n < self.active_number]
+            if len(sealed) < 2:
+                return
+
+            last_sealed = sealed[-1]
+            live = [(doc_id, doc) for doc_id, doc in self.docs.items()
+                    if self.locations[doc_id] <= last_sealed]
+
+        # The records are written out without holding the lock. Anything
+        # written in the meantime goes to the active segment, which comes
+        # after the compacted one and so takes precedence over it.
+        tmp_path = self._segment_path(last_sealed) + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(b'{"compacted": true}\n')
+            for doc_id, doc in live:
+                f.write(bytes(json.dumps({'doc_id': doc_id, 'doc': doc}),
+                              encoding='utf8') + b'\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+        with self.lock:
+            os.replace(tmp_path, self._segment_path(last_sealed))
+            for number in sealed[:-1]:
+                os.remove(self._segment_path(number))
+
+    def _matches(self, doc, where_fields):
+        return all(doc.get(k) == v for k, v in where_fields.items())
+
+    # The doc_ids of the records matching `where_fields`, in doc_id order.
+    # Lookups by id go through the id index rather than scanning the table.
+    def _find(self, where_fields):
+        if 'id' in where_fields:
+            candidates = sorted(self.doc_ids_by_id.get(where_fields['id'], ()))
+        else:
+            candidates = self.docs.keys()
+
+        return [doc_id for doc_id in candidates
+                if self._matches(self.docs[doc_id], where_fields)]
+
+    def all(self):
+        with self.lock:
+            return [dict(doc) for doc in self.docs.values()]
+
+    def project(self, *fields):
+        with self.lock:
+            return [{field: doc.get(field) for field in fields}
+                    for doc in self.docs.values()]
+
+    def search(self, **where_fields):
+        with self.lock:
+            return [dict(self.docs[doc_id]) for doc_id in self._find(where_fields)]
+
+    def search_in(self, field, values):
+        values = set(values)
+        with self.lock:
+            if field == 'id':
+                doc_ids = sorted(doc_id for id in values
+                                 for doc_id in self.doc_ids_by_id.get(id, ()))
+                return [dict(self.docs[doc_id]) for doc_id in doc_ids]
+
+            return [dict(doc) for doc in self.docs.values()
+                    if doc.get(field) in values]
+
+    def get(self, **where_fields):
+        found = self.search(**where_fields)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def insert(self, doc):
+        self.insert_multiple([doc])
+
+    def insert_multiple(self, docs):
+        with self.lock:
+            entries = []
+            for doc in docs:
+                entries += [{'doc_id': self.next_doc_id, 'doc': dict(doc)}]
+                self.next_doc_id += 1
+            self._append(entries)
+
+    def update(self, fields, **where_fields):
+        with self.lock:
+            self._append([{'doc_id': doc_id, 'doc': {**self.docs[doc_id], **fields}}
+                          for doc_id in self._find(where_fields)])
+
+    def remove(self, **where_fields):
+        with self.lock:
+            self._append([{'doc_id': doc_id, 'deleted': True}
+                          for doc_id in self._find(where_fields)])
+
+    def remove_in(self, field, values):
+        values = set(values)
+        with self.lock:
+            if field == 'id':
+                doc_ids = sorted(doc_id for id in values
+                                 for doc_id in self.doc_ids_by_id.get(id, ()))
+            else:
+                doc_ids = [doc_id for doc_id, doc in self.docs.items()
+                           if doc.get(field) in values]
+            self._append([{'doc_id': doc_id, 'deleted': True}
+                          for doc_id in doc_ids])
+
+    def __len__(self):
+        return len(self.docs)
+
+
+class LogStorage(object):
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.log_dir = os.path.join(data_dir, 'log')
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.written_tables = set()
+        self.tables = {}
+
+        cfg = config.load_config(data_dir)
+        self.segment_size = cfg['log_segment_size']
+        self.compaction_interval = cfg['log_compaction_interval']
+        self.fsync = cfg['log_fsync']
+
+        self.compaction_wanted = threading.Event()
+        self.compaction_thread = None
+
+    # Starts compacting in the background. Until it's started, tables only
+    # grow, which is all that scripts run against a data directory need.
+    def start_compactor(self):
+        if self.compaction_thread is None:
+            self.compaction_thread = threading.Thread(
+                target=self._compaction_loop, daemon=True)
+            self.compaction_thread.start()
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = LogTable(self, name)
+            return self.tables[name]
+
+    def flush(self):
+        for table in self.written_tables:
+            table.flush()
+        self.written_tables = set()
+
+    # The entries appended inside a batch are written when it ends, with one
+    # write per table, and if the batch fails they're thrown away instead.
+    # The tables are written one at a time, and a write cut short by a crash
+    # is only cut back to its last whole line when the table is replayed, so
+    # unlike with the SQLite backend a crash part way through can leave some
+    # of a batch written and some not.
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield
+            except:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    for table in self.written_tables:
+                        table.discard()
+                    self.written_tables = set()
+                raise
+            else:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.flush()
+
+    def compact(self):
+        with self.lock:
+            tables = list(self.tables.values())
+        for table in tables:
+            table.compact()
+
+    def _compaction_loop(self):
+        while True:
+            self.compaction_wanted.wait(self.compaction_interval)
+            self.compaction_wanted.clear()
+            try:
+                self.compact()
+            except Exception as e:
+                print('LOG COMPACTION FAILED', repr(e))
@@ -1,13 +1,14 @@
 import os
 
-from tinydb import TinyDB, Query
+import src.storage as storage
 
 
 class OutboxManager(object):
 
     def __init__(self, data_dir):
         self.data_dir = data_dir
-        self.outbox_db = TinyDB(os.path.join(self.data_dir, 'outbox.json'))
+        self.storage = storage.open_storage(self.data_dir)
+        self.outbox_db = self.storage.table('outbox')
 
     def all_messages(self):
         self.outbox_db.all()
@@ -16,4 +17,4 @@ class OutboxManager(object):
         self.outbox_db.insert(msg)
 
     def remove_message_with_id(self, msg_id):
-        self.outbox_db.remove(Query().id == msg_id)
+        self.outbox_db.remove(id=msg_id)
@@ -0,0 +1,91 @@
+import threading
+import time
+
+import requests
+
+import src.config as config
+
+
+# Raised instead of making a request to a blade whose circuit is open.
+class PeerUnavailable(requests.exceptions.ConnectionError):
+    pass
+
+
+# The PeerHealth registry keeps track of how requests to each blade have been
+# going. When too many requests to a blade fail in a row, its circuit opens,
+# and requests to it fail straight away instead of each waiting to time out.
+# Once the cooldown has passed, a single request is let through to probe the
+# blade. If that succeeds the circuit closes again, and if it fails the
+# circuit stays open for another cooldown.
+class PeerHealth(object):
+
+    def __init__(self, data_dir):
+        cfg = config.load_config(data_dir)
+        self.failure_threshold = cfg['peer_failure_threshold']
+        self.cooldown = cfg['peer_cooldown']
+
+        self.lock = threading.Lock()
+
+        # host -> {'failures', 'opened_at', 'probing', 'latency', ...}
+        self.peers = {}
+
+    def _peer(self, host):
+        if host not in self.peers:
+            self.peers[host] = {
+                'failures': 0,
+                'opened_at': None,
+                'probing': False,
+                'latency': None,
+                'successes': 0,
+                'total_failures': 0
+            }
+        return self.peers[host]
+
+    # Checks whether a request to `host` should be made, raising
+    # PeerUnavailable if not.
+    def check(self, host):
+        with self.lock:
+            peer = self._peer(host)
+
+            if peer['opened_at'] is None:
+                return
+
+            if not peer['probing'] and time.monotonic() - peer['opened_at'] >= self.cooldown:
+                peer['probing'] = True
+                return
+
+        raise PeerUnavailable(host + ' is unavailable')
+
+    def record_success(self, host, latency):
+        with self.lock:
+            peer = self._peer(host)
+            peer['failures'] = 0
+            peer['opened_at'] = None
+            peer['probing'] = False
+            peer['successes'] += 1
+
+            # an exponentially weighted moving average, in seconds
+            if peer['latency'] is None:
+                peer['latency'] = latency
+            else:
+                peer['latency'] = 0.8 * peer['latency'] + 0.2 * latency
+
+    def record_failure(self, host):
+        with self.lock:
+            peer = self._peer(host)
+            peer['failures'] += 1
+            peer['total_failures'] += 1
+
+            if peer['probing'] or peer['failures'] >= self.failure_threshold:
+                peer['opened_at'] = time.monotonic()
+            peer['probing'] = False
+
+    def stats(self):
+        with self.lock:
+            return {host: {
+                'available': peer['opened_at'] is None,
+                'consecutive_failures': peer['failures'],
+                'failures': peer['total_failures'],
+                'successes': peer['successes'],
+                'latency': peer['latency']
+            } for host, peer in self.peers.items()}
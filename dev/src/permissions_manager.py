@@ -1,6 +1,7 @@
 import os
+import random
 
-from tinydb import TinyDB, Query
+import src.storage as storage
 
 
 class PermissionsManager(object):
@@ -8,70 +9,92 @@ class PermissionsManager(object):
     def __init__(self, data_dir):
         self.data_dir = data_dir
         self.permissions_dir = os.path.join(self.data_dir, 'permissions')
-        self.permissions_groups_db = TinyDB(
-            os.path.join(self.permissions_dir, 'groups.json'))
-        self.permissions_blades_db = TinyDB(
-            os.path.join(self.permissions_dir, 'blades.json'))
+        self.storage = storage.open_storage(self.data_dir)
+        self.permissions_groups_db = self.storage.table('permissions_groups')
+        self.permissions_blades_db = self.storage.table('permissions_blades')
+
+        # changes whenever any blade's or group's permissions change
+        self.permissions_version = self.new_version()
+
+    def new_version(self):
+        return ''.join([random.choice('0123456789abcdef') for i in range(30)])
 
     def all_blades(self):
         return self.permissions_blades_db.all()
 
     def permissions_for_blade(self, public_signing_key):
         return self.permissions_blades_db.search(
-            Query().public_signing_key == public_signing_key)
+            public_signing_key=public_signing_key)
 
     def set_permissions_for_blade(self, public_signing_key, perms):
         if self.permissions_for_blade(public_signing_key):
             if perms:
                 self.permissions_blades_db.update(
-                    {'permissions': perms}, Query().public_signing_key == public_signing_key)
+                    {'permissions': perms}, public_signing_key=public_signing_key)
             else:
                 self.permissions_blades_db.remove(
-                    Query().public_signing_key == public_signing_key)
+                    public_signing_key=public_signing_key)
         else:
             self.permissions_blades_db.insert({
                 'public_signing_key': public_signing_key,
                 'permissions': perms
             })
+        self.permissions_version = self.new_version()
 
     def all_groups(self):
         return self.permissions_groups_db.all()
 
     def add_group(self, grp):
         self.permissions_groups_db.insert(grp)
+        self.permissions_version = self.new_version()
 
     def permissions_for_group(self, group_id):
-        self.permissions_groups_db.search(Query().id == group_id)
+        self.permissions_groups_db.search(id=group_id)
 
     def update_group(self, group_id, grp):
-        self.permissions_groups_db.update(grp, Query().id == group_id)
+        self.permissions_groups_db.update(grp, id=group_id)
+        self.permissions_version = self.new_version()
 
     def remove_group(self, group_id):
-        self.permissions_groups_db.remove(Query().id == group_id)
+        self.permissions_groups_db.remove(id=group_id)
+        self.permissions_version = self.new_version()
 
     def permitted_to_view_message(self, public_signing_key, permissions_categories):
-        if len(permissions_categories) == 0:
+        return self.permitted_by(self.effective_permissions(public_signing_key),
+                                 permissions_categories)
+
+    # Gets everything a blade is permitted to view, from its own permissions
+    # and those of every group it's in. This is either 'all', or a sorted
+    # tuple of the categories it can view, so blades that can view the same
+    # messages have equal effective permissions.
+    def effective_permissions(self, public_signing_key):
+        if public_signing_key is None:
+            return ()
+
+        perms = []
+
+        # the blade's direct permissions
+        blades = self.permissions_blades_db.search(
+            public_signing_key=public_signing_key)
+        if blades:
+            perms += [blades[0]['permissions']]
+
+        # the permissions of the groups the blade is in
+        for grp in self.permissions_groups_db.all():
+            if public_signing_key in grp['members']:
+                perms += [grp['permissions']]
+
+        categories = set()
+        for perm in perms:
+            if perm['type'] == 'all':
+                return 'all'
+            elif perm['type'] == 'categories':
+                categories.update(perm['categories'])
+
+        return tuple(sorted(categories))
+
+    def permitted_by(self, effective_permissions, permissions_categories):
+        if len(permissions_categories) == 0 or effective_permissions == 'all':
             return True
 
-        if public_signing_key is not None:
-
-            # determine if the blade has direct permissions
-            blades = self.permissions_blades_db.search(
-                Query().public_signing_key == public_signing_key)
-            if blades:
-                perm = blades[0]['permissions']
-                if perm['type'] == 'all':
-                    return True
-                elif perm['type'] == 'categories' and any([k in perm['categories'] for k in permissions_categories]):
-                    return True
-
-            # determine if the blade is in any permissions group with access
-            for grp in self.permissions_groups_db.all():
-                if public_signing_key in grp['members']:
-                    perm = grp['permissions']
-                    if perm['type'] == 'all':
-                        return True
-                    elif perm['type'] == 'categories' and any([k in perm['categories'] for k in permissions_categories]):
-                        return True
-
-        return False
+        return any([k in effective_permissions for k in permissions_categories])
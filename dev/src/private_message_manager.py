@@ -4,33 +4,37 @@ import os
 import random
 import requests
 
-from tinydb import TinyDB, Query
+import src.storage as storage
 
 
 class PrivateMessageManager(object):
 
-    def __init__(self, data_dir, identity_manager, encryption_manager, known_blades_manager, subscriptions_manager):
+    def __init__(self, data_dir, identity_manager, encryption_manager, known_blades_manager, subscriptions_manager, timeline_manager, http_client, delivery_queue, background):
         self.data_dir = data_dir
         self.identity_manager = identity_manager
         self.encryption_manager = encryption_manager
         self.known_blades_manager = known_blades_manager
         self.subscriptions_manager = subscriptions_manager
-        self.inbox_db = TinyDB(os.path.join(self.data_dir, 'inbox.json'))
-        self.outbox_db = TinyDB(os.path.join(self.data_dir, 'outbox.json'))
-        self.private_messages_db = TinyDB(
-            os.path.join(self.data_dir, 'private_messages.json'))
+        self.timeline_manager = timeline_manager
+        self.http_client = http_client
+        self.delivery_queue = delivery_queue
+        self.background = background
+        self.storage = storage.open_storage(self.data_dir)
+        self.inbox_db = self.storage.table('inbox')
+        self.outbox_db = self.storage.table('outbox')
+        self.private_messages_db = self.storage.table('private_messages')
 
     def all_inbox_messages(self):
         self.inbox_db.all()
 
     def inbox_message_with_id(self, msg_id):
-        self.inbox_db.search(Query().origin_id == msg_id)
+        self.inbox_db.search(origin_id=msg_id)
 
     def add_inbox_message(self, msg):
         self.inbox_db.insert(msg)
 
     def remove_inbox_message_with_id(self, msg_id):
-        self.inbox_db.remove(Query().id == msg_id)
+        self.inbox_db.remove(id=msg_id)
 
     def handle_new_inbox_message(self, inbox_msg):
 
@@ -39,29 +43,46 @@ class PrivateMessageManager(object):
             self.subscriptions_manager.add_subscriber(
                 inbox_msg['public_signing_key'], inbox_msg['url'])
 
+        elif inbox_msg['type'] == 'new_feed_messages':
+            # Only the subscription that has new messages is fetched, and only
+            # if it is one of our subscriptions.
+            if self.subscriptions_manager.is_subscribed_to(inbox_msg['public_signing_key']):
+                self.timeline_manager.request_refresh(
+                    inbox_msg['public_signing_key'])
+
         elif inbox_msg['type'] == 'new_private_messages':
             print('RECEIVED NEW PMs')
+            # the sender's outbox is fetched in the background, so a slow
+            # sender can't hold up its own notification
+            self.background.run('FETCH PMs ' + inbox_msg['url'],
+                                self.fetch_private_messages, inbox_msg)
+
+        return True
+
+    def fetch_private_messages(self, inbox_msg):
+        try:
             resp_data = self.encryption_manager.encrypted_client_request(
                 inbox_msg['public_signing_key'],
-                requests.get,
+                self.http_client.get,
                 'http://' + inbox_msg['url'] + '/api/outbox')
-
-            if resp_data:
-                received_messages = json.loads(resp_data)
-
-                for outbox_msg in received_messages:
-                    if not self.inbox_message_with_id(outbox_msg['id']):
-                        self.add_inbox_message({
-                            'id': ''.join([random.choice('0123456789abcdef')
-                                           for i in range(30)]),
-                            'origin_id': outbox_msg['id'],
-                            'sender': inbox_msg['public_signing_key'],
-                            'sent_datetime': outbox_msg['sent_datetime'],
-                            'type': outbox_msg['type'],
-                            'content': outbox_msg['content']
-                        })
-
-        return True
+        except requests.exceptions.RequestException as e:
+            print('FAILED TO FETCH PMs', inbox_msg['url'], e)
+            resp_data = None
+
+        if resp_data:
+            received_messages = json.loads(resp_data)
+
+            for outbox_msg in received_messages:
+                if not self.inbox_message_with_id(outbox_msg['id']):
+                    self.add_inbox_message({
+                        'id': ''.join([random.choice('0123456789abcdef')
+                                       for i in range(30)]),
+                        'origin_id': outbox_msg['id'],
+                        'sender': inbox_msg['public_signing_key'],
+                        'sent_datetime': outbox_msg['sent_datetime'],
+                        'type': outbox_msg['type'],
+                        'content': outbox_msg['content']
+                    })
 
     def all_outbox_messages(self):
         return self.outbox_db.all()
@@ -80,17 +101,17 @@ class PrivateMessageManager(object):
 
         self.outbox_db.insert(msg)
 
-        requests.post('http://' + blade_id['url'] + '/api/inbox',
-                      data=json.dumps({
-                          'type': 'new_private_messages',
-                          'url': self.identity_manager.blade_url(),
-                          'public_signing_key': self.identity_manager.public_signing_key()
-                      }))
+        self.delivery_queue.enqueue('http://' + blade_id['url'] + '/api/inbox',
+                                    json.dumps({
+                                        'type': 'new_private_messages',
+                                        'url': self.identity_manager.blade_url(),
+                                        'public_signing_key': self.identity_manager.public_signing_key()
+                                    }))
 
         return True
 
     def remove_outbox_message_with_id(self, msg_id):
-        self.outbox_db.remove(Query().id == msg_id)
+        self.outbox_db.remove(id=msg_id)
 
     def add_private_message_own_turn(self, msg):
         ...
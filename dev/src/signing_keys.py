@@ -0,0 +1,14 @@
+import functools
+
+import nacl.encoding
+import nacl.signing
+
+
+# Parsing a public signing key means base64 decoding it and building a
+# VerifyKey from it, which every authorized request and every response from a
+# peer would otherwise do again. The same few peers sign almost everything a
+# blade sees, so the parsed keys are kept in an LRU cache.
+@functools.lru_cache(maxsize=1024)
+def verify_key(public_signing_key):
+    return nacl.signing.VerifyKey(bytes(public_signing_key.strip(), encoding='ascii'),
+                                  encoder=nacl.encoding.Base64Encoder)
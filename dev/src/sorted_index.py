@@ -0,0 +1,92 @@
+import bisect
+import threading
+
+
+# A SortedIndex keeps the (datetime, id) keys of the records in a table in
+# sorted order, together with a map from id to key, so that pages of records
+# can be found by bisecting instead of by searching and sorting the table.
+class SortedIndex(object):
+
+    def __init__(self, records=[], datetime_field='publish_datetime'):
+        self.datetime_field = datetime_field
+        self.lock = threading.Lock()
+        self.keys_by_id = {rec['id']: (rec[datetime_field], rec['id'])
+                           for rec in records}
+        self.keys = sorted(self.keys_by_id.values())
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, id):
+        return id in self.keys_by_id
+
+    def add(self, record):
+        key = (record[self.datetime_field], record['id'])
+        with self.lock:
+            if record['id'] in self.keys_by_id:
+                self._remove(record['id'])
+            bisect.insort(self.keys, key)
+            self.keys_by_id[record['id']] = key
+
+    def remove(self, id):
+        with self.lock:
+            self._remove(id)
+
+    def _remove(self, id):
+        key = self.keys_by_id.pop(id, None)
+        if key is None:
+            return
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def key_for_id(self, id):
+        return self.keys_by_id.get(id)
+
+    # The ids of at most `count` records that come strictly before `key`,
+    # newest first. With no key, the newest records are returned.
+    def ids_before(self, key=None, count=None):
+        with self.lock:
+            if key is None:
+                end = len(self.keys)
+            else:
+                end = bisect.bisect_left(self.keys, key)
+            start = 0 if count is None else max(0, end - count)
+            return [k[1] for k in reversed(self.keys[start:end])]
+
+    # The ids of at most `count` records that come strictly after `key`,
+    # oldest first. With no key, the oldest records are returned.
+    def ids_after(self, key=None, count=None):
+        with self.lock:
+            if key is None:
+                start = 0
+            else:
+                start = bisect.bisect_right(self.keys, key)
+            end = len(self.keys) if count is None else start + count
+            return [k[1] for k in self.keys[start:end]]
+
+    # Walks backwards through the index from `key`, fetching the records in
+    # chunks from `table`, until `count` records satisfying `predicate` have
+    # been found or the index runs out.
+    def page(self, table, key=None, count=None, predicate=lambda rec: True):
+        found = []
+        chunk_size = max(count or 0, 16)
+
+        while count is None or len(found) < count:
+            ids = self.ids_before(key, chunk_size)
+            if not ids:
+                break
+
+            records_by_id = {rec['id']: rec for rec in table.search_in('id', ids)}
+            for id in ids:
+                rec = records_by_id.get(id)
+                if rec is not None and predicate(rec):
+                    found += [rec]
+                    if count is not None and len(found) == count:
+                        break
+
+            key = self.key_for_id(ids[-1])
+            if key is None:
+                break
+
+        return found
@@ -0,0 +1,389 @@
+import contextlib
+import functools
+import json
+import os
+import re
+import sqlite3
+import threading
+
+from tinydb import TinyDB, where
+from tinydb.middlewares import CachingMiddleware
+from tinydb.storages import JSONStorage as JSONFileStorage
+
+import src.config as config
+import src.lazy_json_storage as lazy_json_storage
+import src.log_storage as log_storage
+
+
+# Every table a blade keeps, together with the file that the JSON backend has
+# always stored it in, relative to the data directory.
+TABLE_FILES = {
+    'feed': 'feed.json',
+    'timeline_cache': 'timeline_cache.json',
+    'subscriptions': 'subscriptions.json',
+    'subscribers': 'subscribers.json',
+    'known_blades': 'known_blades.json',
+    'inbox': 'inbox.json',
+    'outbox': 'outbox.json',
+    'private_messages': 'private_messages.json',
+    'permissions_groups': os.path.join('permissions', 'groups.json'),
+    'permissions_blades': os.path.join('permissions', 'blades.json'),
+    'delivery_queue': 'delivery_queue.json',
+}
+
+# The fields that the managers look documents up by. Backends that support
+# indexes build one for each of these.
+INDEXED_FIELDS = {
+    'feed': ['id', 'publish_datetime'],
+    'timeline_cache': ['id', 'publish_datetime', 'origin_id'],
+    'subscriptions': ['id', 'public_signing_key', 'url'],
+    'subscribers': ['public_signing_key'],
+    'known_blades': ['public_signing_key'],
+    'inbox': ['id', 'origin_id'],
+    'outbox': ['id'],
+    'private_messages': ['id'],
+    'permissions_groups': ['id'],
+    'permissions_blades': ['public_signing_key'],
+    'delivery_queue': ['id', 'url'],
+}
+
+
+# TinyDB's CachingMiddleware writes the file on its own after every 1000
+# writes. The JSON backend decides when files are written, so that a batch is
+# written once and can be thrown away if it fails.
+class FlushOnlyCachingMiddleware(CachingMiddleware):
+
+    WRITE_CACHE_SIZE = float('inf')
+
+
+# The JSON backend stores each table in its own TinyDB file, exactly the way
+# blades always have. Every write rewrites the whole file, but the files are
+# only read once, and writes made inside a batch are flushed together.
+class JSONTable(object):
+
+    def __init__(self, storage, path):
+        self.storage = storage
+        self.path = path
+        self.db = TinyDB(path, storage=FlushOnlyCachingMiddleware(JSONFileStorage))
+
+    def _write(self, f, *args):
+        with self.storage.lock:
+            f(*args)
+            self.storage.written_tables.add(self)
+            if self.storage.batch_depth == 0:
+                self.storage.flush()
+
+    def flush(self):
+        self.db.storage.flush()
+
+    # Throws away any writes that haven't been flushed yet, by reading the
+    # table again from its file. The old database isn't closed, since closing
+    # it would flush the writes.
+    def discard(self):
+        self.db = TinyDB(self.path, storage=FlushOnlyCachingMiddleware(JSONFileStorage))
+
+    def all(self):
+        with self.storage.lock:
+            return self.db.all()
+
+    # Reads just the given fields of every record, with None for any a record
+    # doesn't have, so that indexes can be built without keeping whole
+    # records around.
+    def project(self, *fields):
+        with self.storage.lock:
+            return [{field: doc.get(field) for field in fields}
+                    for doc in self.db.all()]
+
+    def search(self, **where_fields):
+        if not where_fields:
+            return self.all()
+        with self.storage.lock:
+            return self.db.search(_tinydb_condition(where_fields))
+
+    def search_in(self, field, values):
+        with self.storage.lock:
+            return self.db.search(_tinydb_in_condition(field, values))
+
+    def get(self, **where_fields):
+        found = self.search(**where_fields)
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def insert(self, doc):
+        self._write(self.db.insert, doc)
+
+    def insert_multiple(self, docs):
+        self._write(self.db.insert_multiple, docs)
+
+    def update(self, fields, **where_fields):
+        self._write(self.db.update, fields, _tinydb_condition(where_fields))
+
+    def remove(self, **where_fields):
+        self._write(self.db.remove, _tinydb_condition(where_fields))
+
+    def remove_in(self, field, values):
+        self._write(self.db.remove, _tinydb_in_condition(field, values))
+
+    def __len__(self):
+        with self.storage.lock:
+            return len(self.db)
+
+
+class JSONStorage(object):
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.written_tables = set()
+        self.tables = {}
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = JSONTable(
+                    self, os.path.join(self.data_dir, TABLE_FILES[name]))
+            return self.tables[name]
+
+    def flush(self):
+        for table in self.written_tables:
+            table.flush()
+        self.written_tables = set()
+
+    # Each file written inside a batch is written once, when the batch ends.
+    # The files are still written one at a time, so unlike with the SQLite
+    # backend a crash part way through can leave some of them unwritten.
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            self.batch_depth += 1
+            try:
+                yield
+            except:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    for table in self.written_tables:
+                        table.discard()
+                    self.written_tables = set()
+                raise
+            else:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.flush()
+
+
+# On every backend, a document that doesn't have a field matches the field
+# being None, the same as one that has it set to None.
+def _tinydb_field_condition(field, value):
+    if value is None:
+        return (where(field) == None) | ~where(field).exists()
+    return where(field) == value
+
+
+def _tinydb_condition(where_fields):
+    return functools.reduce(lambda a, b: a & b,
+                            [_tinydb_field_condition(k, v) for k, v in where_fields.items()])
+
+
+def _tinydb_in_condition(field, values):
+    values = set(values)
+    condition = where(field).one_of(list(values - {None}))
+    if None in values:
+        condition = condition | _tinydb_field_condition(field, None)
+    return condition
+
+
+# The SQLite backend keeps every table in one database file, in WAL mode, with
+# one row per document. Writes only touch the rows that changed.
+class SQLiteTable(object):
+
+    def __init__(self, storage, name):
+        self.storage = storage
+        self.name = name
+
+        with self.storage.batch() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" (doc_id INTEGER PRIMARY KEY AUTOINCREMENT, doc TEXT NOT NULL)' % name)
+            for field in INDEXED_FIELDS.get(name, []):
+                connection.execute(
+                    'CREATE INDEX IF NOT EXISTS "%s_%s" ON "%s" (%s)' % (name, field, name, _sql_field(field)))
+
+    def _select(self, clause='', params=(), limit=''):
+        with self.storage.lock:
+            rows = self.storage.connection.execute(
+                'SELECT doc FROM "%s" %s ORDER BY doc_id %s' % (self.name, clause, limit), params).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def all(self):
+        return self._select()
+
+    def project(self, *fields):
+        with self.storage.lock:
+            rows = self.storage.connection.execute(
+                'SELECT %s FROM "%s" ORDER BY doc_id' % (', '.join(_sql_field(field) for field in fields), self.name)).fetchall()
+        return [dict(zip(fields, row)) for row in rows]
+
+    def search(self, **where_fields):
+        clause, params = _sql_condition(where_fields)
+        return self._select(clause, params)
+
+    def search_in(self, field, values):
+        values = list(set(values))
+        found = []
+        # SQLite limits the number of parameters per statement.
+        for i in range(0, len(values), 500):
+            clause, params = _sql_in_condition(field, values[i:i + 500])
+            found += self._select('WHERE ' + clause, params)
+        return found
+
+    def get(self, **where_fields):
+        clause, params = _sql_condition(where_fields)
+        found = self._select(clause, params, 'LIMIT 1')
+        if len(found) == 0:
+            return None
+        return found[0]
+
+    def insert(self, doc):
+        self.insert_multiple([doc])
+
+    def insert_multiple(self, docs):
+        with self.storage.batch() as connection:
+            connection.executemany('INSERT INTO "%s" (doc) VALUES (?)' % self.name,
+                                   [(json.dumps(doc),) for doc in docs])
+
+    def update(self, fields, **where_fields):
+        clause, params = _sql_condition(where_fields)
+        with self.storage.batch() as connection:
+            rows = connection.execute('SELECT doc_id, doc FROM "%s" %s' % (self.name, clause),
+                                      params).fetchall()
+            for doc_id, doc in rows:
+                doc = json.loads(doc)
+                doc.update(fields)
+                connection.execute('UPDATE "%s" SET doc = ? WHERE doc_id = ?' % self.name,
+                                   (json.dumps(doc), doc_id))
+
+    def remove(self, **where_fields):
+        clause, params = _sql_condition(where_fields)
+        with self.storage.batch() as connection:
+            connection.execute('DELETE FROM "%s" %s' %
+                               (self.name, clause), params)
+
+    def remove_in(self, field, values):
+        values = list(set(values))
+        with self.storage.batch() as connection:
+            for i in range(0, len(values), 500):
+                clause, params = _sql_in_condition(field, values[i:i + 500])
+                connection.execute('DELETE FROM "%s" WHERE %s' % (self.name, clause),
+                                   params)
+
+    def __len__(self):
+        with self.storage.lock:
+            return self.storage.connection.execute('SELECT COUNT(*) FROM "%s"' % self.name).fetchone()[0]
+
+
+class SQLiteStorage(object):
+
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+        self.lock = threading.RLock()
+        self.batch_depth = 0
+        self.connection = sqlite3.connect(os.path.join(data_dir, 'labrys.sqlite3'),
+                                          isolation_level=None,
+                                          check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.tables = {}
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                self.tables[name] = SQLiteTable(self, name)
+            return self.tables[name]
+
+    # Everything written inside a batch is committed in a single transaction.
+    # Batches can be nested, in which case only the outermost one commits.
+    @contextlib.contextmanager
+    def batch(self):
+        with self.lock:
+            if self.batch_depth == 0:
+                self.connection.execute('BEGIN IMMEDIATE')
+            self.batch_depth += 1
+            try:
+                yield self.connection
+            except:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.connection.execute('ROLLBACK')
+                raise
+            else:
+                self.batch_depth -= 1
+                if self.batch_depth == 0:
+                    self.connection.execute('COMMIT')
+
+
+def _sql_field(field):
+    if not re.match('^[A-Za-z_][A-Za-z0-9_]*$', field):
+        raise ValueError('invalid field name: ' + field)
+    return "json_extract(doc, '$.%s')" % field
+
+
+def _sql_condition(where_fields):
+    if not where_fields:
+        return '', ()
+
+    clauses = []
+    params = []
+    for field, value in where_fields.items():
+        if value is None:
+            clauses += [_sql_field(field) + ' IS NULL']
+        else:
+            clauses += [_sql_field(field) + ' = ?']
+            params += [value]
+
+    return 'WHERE ' + ' AND '.join(clauses), tuple(params)
+
+
+# json_extract gives NULL for a missing field as well as for a null one, so
+# IS NULL matches both, like the other backends. IN never matches NULL, so
+# None is matched separately.
+def _sql_in_condition(field, values):
+    params = [value for value in values if value is not None]
+    clauses = []
+    if params:
+        clauses += ['%s IN (%s)' % (_sql_field(field), ', '.join('?' * len(params)))]
+    if None in values:
+        clauses += [_sql_field(field) + ' IS NULL']
+    return '(' + ' OR '.join(clauses) + ')', tuple(params)
+
+
+BACKENDS = {
+    'json': JSONStorage,
+    'sqlite': SQLiteStorage,
+    'log': log_storage.LogStorage,
+    'lazy_json': functools.partial(lazy_json_storage.LazyJSONStorage,
+                                   table_files=TABLE_FILES),
+}
+
+# Backends that keep their data in the same TinyDB files, so a blade can be
+# switched between them without moving anything.
+JSON_FILE_BACKENDS = {'json', 'lazy_json'}
+
+_open_storages = {}
+_open_storages_lock = threading.Lock()
+
+
+# All of the managers for a blade share the same storage, so that they can
+# share one database connection and write in the same batches.
+def open_storage(data_dir, backend=None):
+    if backend is None:
+        backend = config.load_config(data_dir)['storage_backend']
+
+    if backend not in BACKENDS:
+        raise ValueError('unknown storage backend: ' + backend)
+
+    key = (os.path.abspath(data_dir), backend)
+    with _open_storages_lock:
+        if key not in _open_storages:
+            _open_storages[key] = BACKENDS[backend](data_dir)
+        return _open_storages[key]
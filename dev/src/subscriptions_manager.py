@@ -1,40 +1,64 @@
+import concurrent.futures
 import datetime
 import json
 import os
 import re
 import random
 import requests
+import threading
+import time
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import InvalidToken
 
-from tinydb import TinyDB, Query
-
+import src.config as config
+import src.cursors as cursors
 import src.public_keys as public_keys
+import src.sorted_index as sorted_index
+import src.storage as storage
+
+
+# The errors a subscription can cause by sending back something that isn't a
+# feed, such as malformed JSON, messages missing fields, or content that
+# doesn't decrypt.
+MALFORMED_FEED_ERRORS = (ValueError, KeyError, TypeError,
+                         InvalidToken, InvalidTag)
 
 
 class SubscriptionsManager(object):
 
-    def __init__(self, data_dir, identity_manager, encryption_manager, known_blades_manager):
+    def __init__(self, data_dir, identity_manager, encryption_manager, known_blades_manager, http_client, delivery_queue, background):
         self.data_dir = data_dir
         self.identity_manager = identity_manager
         self.encryption_manager = encryption_manager
         self.known_blades_manager = known_blades_manager
-        self.subscriptions_db = TinyDB(
-            os.path.join(self.data_dir, 'subscriptions.json'))
-        self.subscribers_db = TinyDB(
-            os.path.join(self.data_dir, 'subscribers.json'))
+        self.http_client = http_client
+        self.delivery_queue = delivery_queue
+        self.background = background
+        self.storage = storage.open_storage(self.data_dir)
+        self.subscriptions_db = self.storage.table('subscriptions')
+        self.subscribers_db = self.storage.table('subscribers')
+        self.subscriptions_index = sorted_index.SortedIndex(
+            self.subscriptions_db.project('id', 'subscribe_datetime'),
+            'subscribe_datetime')
+
+        # held while checking whether we're already subscribed to a blade, or
+        # it's already subscribed to us, and adding it if not
+        self.add_lock = threading.Lock()
 
         self.max_list_items_to_display = 3
 
+        cfg = config.load_config(self.data_dir)
+        self.fetch_concurrency = cfg['subscription_fetch_concurrency']
+        self.fetch_timeout = cfg['subscription_fetch_timeout']
+        self.poll_min_interval = cfg['subscription_poll_min_interval']
+        self.poll_max_interval = cfg['subscription_poll_max_interval']
+
     def subscriptions(self, last_seen=None):
-        if last_seen is not None:
-            found = self.subscriptions_db.search(Query().id == last_seen)
-            found.sort(reverse=True, key=lambda s: s['subscribe_datetime'])
-            if found:
-                subs = self.subscriptions_db.search((Query().subscribe_datetime <= found[0]['subscribe_datetime']) &
-                                                    (Query().id != last_seen))
-            else:
-                subs = self.subscriptions_db.all()
-        else:
-            subs = self.subscriptions_db.all()
+        key = cursors.key_for_last_seen(last_seen, self.subscriptions_index)
+
+        subs = self.subscriptions_index.page(self.subscriptions_db,
+                                             key,
+                                             self.max_list_items_to_display + 1)
 
         for sub in subs:
             blade_identity = self.known_blades_manager.cached_blade_identity(
@@ -45,88 +69,270 @@ class SubscriptionsManager(object):
             sub['display_name'] = blade_identity['display_name']
             sub['bio'] = blade_identity['bio']
 
-        subs.sort(reverse=True, key=lambda s: s['subscribe_datetime'])
-
         if len(subs) <= self.max_list_items_to_display:
             next_last_seen = None
         else:
-            next_last_seen = subs[self.max_list_items_to_display - 1]['id']
+            next_last_seen = cursors.cursor_for(
+                subs[self.max_list_items_to_display - 1], 'subscribe_datetime')
 
         subs = subs[:self.max_list_items_to_display]
 
         return subs, next_last_seen
 
+    # Subscribes to the blade at `blade_url`. Its identity is loaded in the
+    # background, so the subscription is added once it has been.
     def add_subscription(self, blade_url):
         match = re.match('^(https?://)?([^/]+)(/.*)?$', blade_url)
 
         if match is None:
             return
 
-        blade_url = match.group(2)
+        self.background.run('ADD SUBSCRIPTION ' + match.group(2),
+                            self.load_subscription, match.group(2))
 
+    def load_subscription(self, blade_url):
         blade_identity = self.known_blades_manager.load_and_cache_blade_identity(
             blade_url)
 
-        if blade_identity and not self.subscriptions_db.search(Query().public_signing_key == blade_identity['public_signing_key']):
+        if blade_identity is None:
+            return
+
+        with self.add_lock:
+            if self.subscriptions_db.get(public_signing_key=blade_identity['public_signing_key']):
+                return
 
-            requests.post('http://' + blade_identity['url'] + '/api/inbox',
-                          data=json.dumps({'url': self.identity_manager.blade_url(),
-                                           'public_signing_key': self.identity_manager.public_signing_key(),
-                                           'type': 'new_subscriber'}))
+            self.delivery_queue.enqueue('http://' + blade_identity['url'] + '/api/inbox',
+                                        json.dumps({'url': self.identity_manager.blade_url(),
+                                                    'public_signing_key': self.identity_manager.public_signing_key(),
+                                                    'type': 'new_subscriber'}))
 
-            self.subscriptions_db.insert({
+            sub = {
                 'id': public_keys.encode_public_key(blade_identity['public_signing_key']),
                 'subscribe_datetime': datetime.datetime.utcnow().isoformat(),
                 'url': blade_url,
                 'public_signing_key': blade_identity['public_signing_key'],
-                'last_seen': None
-            })
+                'last_seen': None,
+                'poll_interval': None,
+                'next_poll_datetime': None,
+                'fetch_failures': 0
+            }
+            self.subscriptions_db.insert(sub)
+            self.subscriptions_index.add(sub)
+
+    def is_subscribed_to(self, public_signing_key):
+        return self.subscriptions_db.get(public_signing_key=public_signing_key) is not None
 
     def remove_subscription(self, sub_id):
         public_signing_key = public_keys.decode_public_key(sub_id)
 
-        self.subscriptions_db.remove(
-            Query().public_signing_key == public_signing_key)
-
-    def update_subscriptions(self):
+        self.subscriptions_db.remove(public_signing_key=public_signing_key)
+        self.subscriptions_index.remove(sub_id)
+
+    # Fetches the new messages from every subscription without writing
+    # anything, so that the caller can store the messages and the changes to
+    # the subscriptions together in one batch. Returns the messages and a map
+    # from public signing key to the fields of that subscription to update.
+    #
+    # The subscriptions are fetched concurrently, so a refresh takes about as
+    # long as the slowest subscription rather than all of them added up. The
+    # results are merged in subscription order, whatever order they arrive in.
+    #
+    # If `public_signing_keys` is given, only those subscriptions are fetched,
+    # and if `only_due` is set, only the subscriptions that are due to be
+    # polled are.
+    def fetch_subscriptions(self, public_signing_keys=None, only_due=False):
         local_messages = []
+        updates = {}
+
+        subs = sorted(self.subscriptions_db.all(),
+                      key=lambda sub: (sub['subscribe_datetime'], sub['id']))
+        if public_signing_keys is not None:
+            subs = [sub for sub in subs
+                    if sub['public_signing_key'] in public_signing_keys]
+        if only_due:
+            now = datetime.datetime.utcnow().isoformat()
+            subs = [sub for sub in subs
+                    if sub.get('next_poll_datetime') is None or sub['next_poll_datetime'] <= now]
+        if not subs:
+            return local_messages, updates
+
+        # Up to `fetch_concurrency` subscriptions are fetched at once, and each
+        # one gets `fetch_timeout` seconds from when its fetch starts. The
+        # timeout on the request itself only applies to each read from the
+        # socket, and retries and a second handshake can add up to much more
+        # than that, so a fetch that's still going at its deadline is counted
+        # as failing and left to finish in the background, and the next
+        # subscription is fetched in its place.
+        results = {}
+        waiting = list(subs)
+        running = {}
+
+        while waiting or running:
+            while waiting and len(running) < self.fetch_concurrency:
+                sub = waiting.pop(0)
+                running[_start(self.fetch_subscription, sub)] = \
+                    (sub, time.monotonic() + self.fetch_timeout)
+
+            next_deadline = min(deadline for _, deadline in running.values())
+            done, _ = concurrent.futures.wait(running,
+                                              max(0, next_deadline - time.monotonic()),
+                                              concurrent.futures.FIRST_COMPLETED)
+
+            for future, (sub, deadline) in list(running.items()):
+                if future in done:
+                    results[sub['id']] = future.result()
+                elif deadline <= time.monotonic():
+                    print('SUBSCRIPTION FETCH TIMED OUT', sub['url'])
+                    results[sub['id']] = [], self.next_poll(sub, None)
+                else:
+                    continue
+                del running[future]
 
-        for sub in self.subscriptions_db.all():
-            resp_data = self.encryption_manager.encrypted_client_request(
+        for sub in subs:
+            messages, fields = results[sub['id']]
+            local_messages += messages
+            updates[sub['public_signing_key']] = fields
+
+        return local_messages, updates
+
+    # Fetches the new messages from one subscription, and works out when to
+    # poll it next. Returns the messages and the fields of the subscription
+    # to update. A subscription that sends back something that isn't a feed
+    # counts as failing, so it can't stop the other subscriptions from being
+    # refreshed.
+    def fetch_subscription(self, sub):
+        try:
+            result = self.fetch_feed(sub)
+        except MALFORMED_FEED_ERRORS as e:
+            print('MALFORMED FEED FROM SUBSCRIPTION', sub['url'], repr(e))
+            result = None
+
+        if result is None:
+            return [], self.next_poll(sub, None)
+
+        messages, fields = result
+        return messages, {**fields, **self.next_poll(sub, len(messages) > 0)}
+
+    # Works out when to poll a subscription next, given whether the last poll
+    # found new messages, or None if it failed. A subscription that has new
+    # messages is polled twice as often as before, and one that doesn't is
+    # polled a bit less often, so each subscription ends up being polled
+    # about as often as it posts. Failures back off exponentially on top of
+    # that until the subscription can be reached again.
+    def next_poll(self, sub, found_new_messages):
+        interval = sub.get('poll_interval') or self.poll_min_interval
+        failures = sub.get('fetch_failures', 0)
+
+        if found_new_messages is None:
+            failures += 1
+            wait = min(self.poll_max_interval, interval * 2 ** failures)
+        else:
+            failures = 0
+            if found_new_messages:
+                interval = max(self.poll_min_interval, interval / 2)
+            else:
+                interval = min(self.poll_max_interval, interval * 1.5)
+            wait = interval
+
+        return {
+            'poll_interval': interval,
+            'fetch_failures': failures,
+            'next_poll_datetime': (datetime.datetime.utcnow() + datetime.timedelta(seconds=wait)).isoformat()
+        }
+
+    # Fetches the new messages from one subscription's feed. Returns the
+    # messages and the fields of the subscription to update, or None if the
+    # fetch failed.
+    #
+    # The feed's ETag from the last fetch is sent back, so that when nothing
+    # has changed the subscription answers 304 Not Modified without reading
+    # or encrypting its feed.
+    #
+    # The newest message seen is sent as its bare id rather than a cursor,
+    # since that's all older blades understand.
+    def fetch_feed(self, sub):
+        headers = {}
+        if sub.get('feed_version'):
+            headers['If-None-Match'] = sub['feed_version']
+
+        last_seen = None
+        if sub['last_seen']:
+            last_seen = cursors.id_for_last_seen(sub['last_seen'])
+
+        try:
+            resp, resp_data = self.encryption_manager.encrypted_client_request_with_response(
                 sub['public_signing_key'],
-                requests.get,
+                self.http_client.get,
                 'http://' + sub['url'] + '/api/feed',
-                {'last_seen': sub['last_seen']})
-
-            if resp_data is not None:
-                messages = json.loads(resp_data)
-                most_recent_datetime = None
-                most_recent_id = None
-                for msg in messages:
-                    if most_recent_datetime is None or (most_recent_datetime is not None and most_recent_datetime < msg['publish_datetime']):
-                        most_recent_id = msg['id']
-
-                    local_messages += [{
-                        'id': ''.join([random.choice('0123456789abcdef')
-                                       for i in range(30)]),
-                        'retrieve_datetime': datetime.datetime.utcnow().isoformat(),
-                        'url': sub['url'],
-                        'public_signing_key': sub['public_signing_key'],
-                        'origin_id': msg['id'],
-                        'publish_datetime': msg['publish_datetime'],
-                        'type': msg['type'],
-                        'content': msg['content']
-                    }]
-
-                if most_recent_id:
-                    self.subscriptions_db.update({'last_seen': most_recent_id}, Query(
-                    ).public_signing_key == sub['public_signing_key'])
-
-        return local_messages
+                {'last_seen': last_seen},
+                headers=headers,
+                timeout=self.fetch_timeout)
+        except requests.exceptions.RequestException as e:
+            print('FAILED TO FETCH SUBSCRIPTION', sub['url'], e)
+            return None
+
+        if resp.status_code == 304:
+            return [], {}
+
+        if resp_data is None:
+            return None
+
+        fields = {}
+        if resp.headers.get('ETag') != sub.get('feed_version'):
+            fields['feed_version'] = resp.headers.get('ETag')
+
+        local_messages = []
+        most_recent = None
+        for msg in json.loads(resp_data):
+            if most_recent is None or (most_recent['publish_datetime'], most_recent['id']) < (msg['publish_datetime'], msg['id']):
+                most_recent = msg
+
+            local_messages += [{
+                'id': ''.join([random.choice('0123456789abcdef')
+                               for i in range(30)]),
+                'retrieve_datetime': datetime.datetime.utcnow().isoformat(),
+                'url': sub['url'],
+                'public_signing_key': sub['public_signing_key'],
+                'origin_id': msg['id'],
+                'publish_datetime': msg['publish_datetime'],
+                'type': msg['type'],
+                'content': msg['content']
+            }]
+
+        if most_recent is not None:
+            fields['last_seen'] = most_recent['id']
+
+        return local_messages, fields
+
+    def record_fetch_state(self, updates):
+        for public_signing_key, fields in updates.items():
+            self.subscriptions_db.update(fields,
+                                         public_signing_key=public_signing_key)
+
+    # Tells every subscriber that something has happened, such as this blade
+    # publishing new feed messages, by sending a notification of the given
+    # type to their inboxes. The notifications are queued in one batch, so
+    # that they cost a single write however many subscribers there are.
+    def notify_subscribers(self, notification_type):
+        notification = json.dumps({'url': self.identity_manager.blade_url(),
+                                   'public_signing_key': self.identity_manager.public_signing_key(),
+                                   'type': notification_type})
+
+        with self.storage.batch():
+            for subscriber in self.all_subscribers():
+                blade_identity = self.known_blades_manager.cached_blade_identity(
+                    subscriber['public_signing_key'])
+                if blade_identity is None:
+                    continue
+
+                self.delivery_queue.enqueue(
+                    'http://' + blade_identity['url'] + '/api/inbox', notification)
 
     def all_subscribers(self):
         return self.subscribers_db.all()
 
+    # Adds the blade at `sub_url` as a subscriber. Like add_subscription, its
+    # identity is loaded in the background.
     def add_subscriber(self, sub_public_signing_key, sub_url):
         print('ADDING NEW SUBSCRIBER')
         match = re.match('^(https?://)?([^/]+)(/.*)?$', sub_url)
@@ -134,13 +340,31 @@ class SubscriptionsManager(object):
         if match is None:
             return
 
-        sub_url = match.group(2)
+        self.background.run('ADD SUBSCRIBER ' + match.group(2),
+                            self.load_subscriber, match.group(2))
 
+    def load_subscriber(self, sub_url):
         sub_identity = self.known_blades_manager.load_and_cache_blade_identity(
             sub_url)
 
-        self.subscribers_db.insert({
-            'id': public_keys.encode_public_key(sub_identity['public_signing_key']),
-            'subscribe_datetime': datetime.datetime.utcnow().isoformat(),
-            'public_signing_key': sub_identity['public_signing_key'],
-        })
+        if sub_identity is None:
+            return
+
+        with self.add_lock:
+            if self.subscribers_db.get(public_signing_key=sub_identity['public_signing_key']):
+                return
+
+            self.subscribers_db.insert({
+                'id': public_keys.encode_public_key(sub_identity['public_signing_key']),
+                'subscribe_datetime': datetime.datetime.utcnow().isoformat(),
+                'public_signing_key': sub_identity['public_signing_key'],
+            })
+
+
+# Runs `f(*args)` on a thread of its own, so that nothing has to wait for it
+# if it's given up on, and returns its future.
+def _start(f, *args):
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(f, *args)
+    executor.shutdown(wait=False)
+    return future
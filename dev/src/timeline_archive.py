@@ -0,0 +1,77 @@
+import gzip
+import json
+import os
+import re
+import threading
+
+
+# The TimelineArchive holds timeline messages that have been evicted from the
+# timeline cache. Messages are kept in gzipped JSON lines files, one for each
+# month of publish datetimes, which are only read when someone pages further
+# back than the timeline cache goes.
+class TimelineArchive(object):
+
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.lock = threading.Lock()
+        os.makedirs(self.archive_dir, exist_ok=True)
+
+        # the most recently read partition, since paging back through the
+        # archive usually reads the same partition several times in a row
+        self.loaded_partition = None
+        self.loaded_messages = []
+
+    def _partition_path(self, partition):
+        return os.path.join(self.archive_dir, partition + '.jsonl.gz')
+
+    def partitions(self):
+        return sorted(f[:-len('.jsonl.gz')] for f in os.listdir(self.archive_dir)
+                      if re.match('^[0-9]{4}-[0-9]{2}\\.jsonl\\.gz$', f))
+
+    def add(self, messages):
+        by_partition = {}
+        for msg in messages:
+            by_partition.setdefault(
+                msg['publish_datetime'][:7], []).append(msg)
+
+        with self.lock:
+            for partition, msgs in by_partition.items():
+                # Appending to a gzip file adds another gzip member to it,
+                # and members are read back as one stream.
+                with gzip.open(self._partition_path(partition), 'ab') as f:
+                    f.write(b''.join(bytes(json.dumps(msg), encoding='utf8') + b'\n'
+                                     for msg in msgs))
+
+                if partition == self.loaded_partition:
+                    self.loaded_partition = None
+
+    def _load(self, partition):
+        if partition != self.loaded_partition:
+            with gzip.open(self._partition_path(partition), 'rb') as f:
+                messages = [json.loads(line) for line in f]
+            messages.sort(reverse=True, key=lambda m: (
+                m['publish_datetime'], m['id']))
+            self.loaded_partition = partition
+            self.loaded_messages = messages
+
+        return self.loaded_messages
+
+    # Gets at most `count` archived messages that come strictly before `key`,
+    # newest first, reading only as many partitions as it takes.
+    def page(self, key=None, count=None, predicate=lambda msg: True):
+        found = []
+
+        with self.lock:
+            for partition in reversed(self.partitions()):
+                if key is not None and partition > key[0][:7]:
+                    continue
+
+                for msg in self._load(partition):
+                    if key is not None and (msg['publish_datetime'], msg['id']) >= key:
+                        continue
+                    if predicate(msg):
+                        found += [dict(msg)]
+                        if count is not None and len(found) == count:
+                            return found
+
+        return found
@@ -1,7 +1,13 @@
+import datetime
 import os
+import threading
+import time
 
-
-from tinydb import TinyDB, Query
+import src.config as config
+import src.cursors as cursors
+import src.sorted_index as sorted_index
+import src.storage as storage
+import src.timeline_archive as timeline_archive
 
 
 class TimelineManager(object):
@@ -11,43 +17,253 @@ class TimelineManager(object):
         self.identity_manager = identity_manager
         self.subscriptions_manager = subscriptions_manager
         self.known_blades_manager = known_blades_manager
-        self.timeline_cache_db = TinyDB(
-            os.path.join(self.data_dir, 'timeline_cache.json'))
+        self.storage = storage.open_storage(self.data_dir)
+        self.timeline_cache_db = self.storage.table('timeline_cache')
+        self.build_indexes()
+        self.timeline_archive = timeline_archive.TimelineArchive(
+            os.path.join(self.data_dir, 'timeline_archive'))
         self.max_list_items_to_display = 3
 
-    def update_subscriptions(self):
+        cfg = config.load_config(self.data_dir)
+        self.retention_max_age_days = cfg['timeline_retention_max_age_days']
+        self.retention_max_messages = cfg['timeline_retention_max_messages']
+        self.retention_max_per_subscription = cfg['timeline_retention_max_per_subscription']
+        self.refresh_interval = cfg['timeline_refresh_interval']
 
-        local_messages = self.subscriptions_manager.update_subscriptions()
+        # The timeline is refreshed by a background thread, so that showing
+        # the timeline never waits on the network.
+        self.last_refreshed = None
+        self.refresh_lock = threading.Lock()
+        self.refresh_wanted = threading.Event()
+        self.refresh_thread = None
 
-        for msg in local_messages:
-            self.timeline_cache_db.insert(msg)
+        # the subscriptions that have told us they have new messages, which
+        # are fetched without waiting for the next full refresh
+        self.requested_refreshes = set()
+        self.requested_refreshes_lock = threading.Lock()
 
-        return local_messages
+    def start_refresher(self):
+        if self.refresh_thread is None:
+            self.refresh_thread = threading.Thread(
+                target=self._refresh_loop, daemon=True)
+            self.refresh_thread.start()
 
-    def timeline(self, last_seen=None):
+    # Every `refresh_interval` seconds, refreshes the subscriptions that are
+    # due to be polled, and in between, refreshes the subscriptions that ask
+    # for it.
+    #
+    # Known blades' avatars are revalidated after each of the regular
+    # refreshes, outside the refresh lock, so that a refresh someone asks for
+    # in the meantime doesn't wait on them.
+    def _refresh_loop(self):
+        while True:
+            self.refresh(only_due=True)
 
-        self.update_subscriptions()
+            try:
+                self.known_blades_manager.revalidate_avatars()
+            except Exception as e:
+                print('AVATAR REVALIDATION FAILED', e)
 
-        if last_seen is None:
-            messages = self.timeline_cache_db.search(Query().type == 'post')
-        else:
-            found = self.timeline_cache_db.search(Query().id == last_seen)
-            found.sort(reverse=True, key=lambda m: m['publish_datetime'])
-            print('FOUND: ', found)
-            if found:
-                messages = self.timeline_cache_db.search((Query().type == 'post') &
-                                                         (Query().publish_datetime <= found[0]['publish_datetime']) &
-                                                         (Query().id != last_seen))
+            if self.refresh_interval is None:
+                next_refresh = None
             else:
-                messages = self.timeline_cache_db.search(
-                    Query().type == 'post')
+                next_refresh = time.monotonic() + self.refresh_interval
+
+            while next_refresh is None or time.monotonic() < next_refresh:
+                if next_refresh is None:
+                    self.refresh_wanted.wait()
+                else:
+                    self.refresh_wanted.wait(
+                        max(0, next_refresh - time.monotonic()))
+                self.refresh_wanted.clear()
+
+                with self.requested_refreshes_lock:
+                    public_signing_keys = self.requested_refreshes
+                    self.requested_refreshes = set()
+
+                if public_signing_keys:
+                    self.refresh(public_signing_keys)
+
+    # Asks the background thread to fetch the given subscription as soon as
+    # it can.
+    def request_refresh(self, public_signing_key):
+        with self.requested_refreshes_lock:
+            self.requested_refreshes.add(public_signing_key)
+        self.refresh_wanted.set()
+
+    # Refreshes the timeline right away, waiting for any refresh that's
+    # already underway to finish first. Returns when the timeline was last
+    # refreshed. If `public_signing_keys` is given, only those subscriptions
+    # are refreshed, and if `only_due` is set, only the ones that are due to
+    # be polled are.
+    def refresh(self, public_signing_keys=None, only_due=False):
+        with self.refresh_lock:
+            try:
+                self.update_subscriptions(public_signing_keys, only_due)
+                if public_signing_keys is None:
+                    self.last_refreshed = datetime.datetime.utcnow().isoformat()
+            except Exception as e:
+                print('TIMELINE REFRESH FAILED', e)
+
+            return self.last_refreshed
+
+    # Builds the indexes from just the fields they need, so that the whole
+    # timeline cache is never in memory at once.
+    def build_indexes(self):
+        keys = self.timeline_cache_db.project(
+            'id', 'publish_datetime', 'public_signing_key', 'origin_id')
+
+        self.timeline_index = sorted_index.SortedIndex(keys)
+
+        # (public_signing_key, origin_id) -> id, so that a message fetched
+        # more than once is only ever cached once
+        self.origin_index = {(msg['public_signing_key'], msg['origin_id']): msg['id']
+                             for msg in keys}
+
+        # public_signing_key -> the index of that subscription's messages, so
+        # that per-subscription retention doesn't have to read the cache
+        by_subscription = {}
+        for msg in keys:
+            by_subscription.setdefault(msg['public_signing_key'], []).append(msg)
+        self.subscription_indexes = {public_signing_key: sorted_index.SortedIndex(msgs)
+                                     for public_signing_key, msgs in by_subscription.items()}
+
+    def update_subscriptions(self, public_signing_keys=None, only_due=False):
+
+        local_messages, updates = self.subscriptions_manager.fetch_subscriptions(
+            public_signing_keys, only_due)
+
+        # The fetched messages and the subscriptions' new last_seen cursors
+        # and feed versions are written together, so that a refresh costs a
+        # single write and the cursors never get ahead of the cached messages.
+        #
+        # The indexes are updated as the batch goes, so that retention sees
+        # the new messages, and if the batch is rolled back they're built
+        # again from what's actually cached. The evicted messages are only
+        # archived once the batch has been written, so a batch that's rolled
+        # back doesn't leave copies of them in the archive.
+        try:
+            with self.storage.batch():
+                for msg in local_messages:
+                    self.upsert_message(msg)
+
+                self.subscriptions_manager.record_fetch_state(updates)
+
+                evicted = self.enforce_retention()
+        except:
+            self.build_indexes()
+            raise
+
+        if evicted:
+            self.timeline_archive.add(evicted)
+
+        return local_messages
+
+    # Caches a fetched message, or, if it's already cached, updates the cached
+    # copy in place.
+    def upsert_message(self, msg):
+        origin_key = (msg['public_signing_key'], msg['origin_id'])
+        existing_id = self.origin_index.get(origin_key)
+
+        if existing_id is None:
+            self.timeline_cache_db.insert(msg)
+            self.timeline_index.add(msg)
+            self.origin_index[origin_key] = msg['id']
+            self.subscription_indexes.setdefault(
+                msg['public_signing_key'], sorted_index.SortedIndex()).add(msg)
+        else:
+            self.timeline_cache_db.update({'retrieve_datetime': msg['retrieve_datetime'],
+                                           'publish_datetime': msg['publish_datetime'],
+                                           'type': msg['type'],
+                                           'content': msg['content']},
+                                          id=existing_id)
+            self.timeline_index.add({**msg, 'id': existing_id})
+            self.subscription_indexes[msg['public_signing_key']].add(
+                {**msg, 'id': existing_id})
+
+    # Removes every copy but the first of each message that was cached more
+    # than once before messages were deduplicated on the way in.
+    def deduplicate_timeline_cache(self):
+        seen = set()
+        duplicate_ids = set()
+
+        keys = self.timeline_cache_db.project(
+            'id', 'retrieve_datetime', 'public_signing_key', 'origin_id')
+        for msg in sorted(keys, key=lambda m: m['retrieve_datetime']):
+            origin_key = (msg['public_signing_key'], msg['origin_id'])
+            if origin_key in seen:
+                duplicate_ids.add(msg['id'])
+            seen.add(origin_key)
+
+        if duplicate_ids:
+            self.timeline_cache_db.remove_in('id', duplicate_ids)
+            for msg in keys:
+                if msg['id'] in duplicate_ids:
+                    self.timeline_index.remove(msg['id'])
+                    self.subscription_indexes[msg['public_signing_key']].remove(
+                        msg['id'])
+
+        self.origin_index = {(msg['public_signing_key'], msg['origin_id']): msg['id']
+                             for msg in keys if msg['id'] not in duplicate_ids}
+
+        return len(duplicate_ids)
+
+    # Removes the messages that the retention settings no longer allow in the
+    # timeline cache, and returns them so that they can be archived.
+    def enforce_retention(self):
+        evicted_ids = set()
+
+        if self.retention_max_age_days is not None:
+            cutoff = (datetime.datetime.utcnow() -
+                      datetime.timedelta(days=self.retention_max_age_days)).isoformat()
+            evicted_ids.update(self.timeline_index.ids_before((cutoff,)))
+
+        if self.retention_max_messages is not None and len(self.timeline_index) > self.retention_max_messages:
+            evicted_ids.update(self.timeline_index.ids_after(
+                None, len(self.timeline_index) - self.retention_max_messages))
+
+        if self.retention_max_per_subscription is not None:
+            for index in self.subscription_indexes.values():
+                if len(index) > self.retention_max_per_subscription:
+                    evicted_ids.update(index.ids_after(
+                        None, len(index) - self.retention_max_per_subscription))
+
+        if not evicted_ids:
+            return []
+
+        evicted = self.timeline_cache_db.search_in('id', evicted_ids)
+        self.timeline_cache_db.remove_in('id', evicted_ids)
+        for msg in evicted:
+            self.timeline_index.remove(msg['id'])
+            self.subscription_indexes[msg['public_signing_key']].remove(msg['id'])
+            self.origin_index.pop(
+                (msg['public_signing_key'], msg['origin_id']), None)
+
+        return evicted
+
+    def timeline(self, last_seen=None):
+        key = cursors.key_for_last_seen(last_seen, self.timeline_index)
+        count = self.max_list_items_to_display + 1
+
+        messages = self.timeline_index.page(self.timeline_cache_db,
+                                            key,
+                                            count,
+                                            lambda msg: msg['type'] == 'post')
 
-        messages.sort(reverse=True, key=lambda m: m['publish_datetime'])
+        # Once the timeline cache runs out, paging carries on into the
+        # archive.
+        if len(messages) < count:
+            if messages:
+                key = (messages[-1]['publish_datetime'], messages[-1]['id'])
+            messages += self.timeline_archive.page(key,
+                                                   count - len(messages),
+                                                   lambda msg: msg['type'] == 'post')
 
         if len(messages) <= self.max_list_items_to_display:
             next_last_seen = None
         else:
-            next_last_seen = messages[self.max_list_items_to_display - 1]['id']
+            next_last_seen = cursors.cursor_for(
+                messages[self.max_list_items_to_display - 1])
 
         messages = messages[:self.max_list_items_to_display]
 
@@ -1,9 +1,16 @@
 import base64
-from flask import request
+from flask import request, make_response
 import functools
+import hashlib
 import json
 import nacl
 
+import src.cipher_suites as cipher_suites
+import src.config as config
+import src.cursors as cursors
+import src.signing_keys as signing_keys
+import src.ttl_cache as ttl_cache
+
 
 class String:
     pass
@@ -78,6 +85,27 @@ def many_header_params(cls):
     return decorator
 
 
+# Answers a conditional request with 304 Not Modified, before any of the
+# decorators or the view under it run, when the client already has the
+# current version of the resource. `current_etag` is called to get the
+# resource's current ETag, which is set on every other response.
+def if_none_match(current_etag):
+    def decorator(f):
+        @functools.wraps(f)
+        def decorated_function(*args, **kwargs):
+            etag = current_etag()
+            if request.if_none_match.contains(etag):
+                resp = make_response('', 304)
+            else:
+                resp = make_response(f(*args, **kwargs))
+            resp.set_etag(etag)
+            return resp
+
+        return decorated_function
+
+    return decorator
+
+
 def query_params(cls):
     def decorator(f):
         @functools.wraps(f)
@@ -209,7 +237,7 @@ class FeedOptions:
         last_seen = [None]
 
         if 'last_seen' in args:
-            last_seen[0] = args['last_seen']
+            last_seen[0] = cursors.parse_last_seen(args['last_seen'])
 
         return last_seen
 
@@ -261,7 +289,7 @@ class TimelineOptions:
         last_seen = [None]
 
         if 'last_seen' in args:
-            last_seen[0] = args['last_seen']
+            last_seen[0] = cursors.parse_last_seen(args['last_seen'])
 
         return last_seen
 
@@ -277,11 +305,35 @@ class SubscriptionsOptions:
         last_seen = [None]
 
         if 'last_seen' in args:
-            last_seen[0] = args['last_seen']
+            last_seen[0] = cursors.parse_last_seen(args['last_seen'])
 
         return last_seen
 
 
+# The paging options for the /api/timeline and /api/subscriptions endpoints,
+# which also take the version of the response to send. Version 1 is what
+# older clients expect, and version 2 is an object with the paging cursor.
+class PageAPIOptions:
+
+    @staticmethod
+    def parse(args):
+
+        if not (len(args) <= 2 and all([k in ['last_seen', 'version'] for k in args])):
+            return None
+
+        params = [None, 1]
+
+        if 'last_seen' in args:
+            params[0] = cursors.parse_last_seen(args['last_seen'])
+
+        if 'version' in args:
+            if args['version'] not in ['1', '2']:
+                return None
+            params[1] = int(args['version'])
+
+        return params
+
+
 class Subscription:
 
     @staticmethod
@@ -347,6 +399,19 @@ class FormPrivateMessage:
 
 class BladeAuthorization:
 
+    # Authorizations that have already been parsed and had their signatures
+    # verified, keyed on a hash of the header, so that a blade presenting the
+    # same authorization again doesn't have it parsed and verified again.
+    # It's sized by the blade's config once the blade calls `configure`.
+    cache = ttl_cache.TTLCache(config.DEFAULTS['authorization_cache_size'],
+                               config.DEFAULTS['authorization_cache_ttl'])
+
+    @staticmethod
+    def configure(data_dir):
+        cfg = config.load_config(data_dir)
+        BladeAuthorization.cache = ttl_cache.TTLCache(
+            cfg['authorization_cache_size'], cfg['authorization_cache_ttl'])
+
     @staticmethod
     def parse(headers):
         if not 'Authorization' in headers:
@@ -357,11 +422,30 @@ class BladeAuthorization:
         if auth_string[:len(prefix)] != prefix:
             return [None]
 
+        key = hashlib.sha256(bytes(auth_string, encoding='utf-8')).digest()
+        verified = BladeAuthorization.cache.get(key)
+        if verified is not None:
+            return [dict(verified)]
+
         try:
             auth_info = json.loads(auth_string[len(prefix):])
         except:
             return [None]
 
+        # a blade resuming a session only sends the session's id, which is
+        # checked against the session by the view, and a nonce for the
+        # response. The nonce is new every time, so these aren't cached.
+        session_type = {'public_signing_key': String,
+                        'session_id': String,
+                        'nonce': String}
+
+        if check(auth_info, session_type):
+            return [{
+                'public_signing_key': auth_info['public_signing_key'],
+                'session_id': auth_info['session_id'],
+                'nonce': auth_info['nonce']
+            }]
+
         auth_type = {'public_signing_key': String,
                      'dh_public_key': String,
                      'signed_dh_public_key': String}
@@ -369,24 +453,42 @@ class BladeAuthorization:
         if not check(auth_info, auth_type):
             return [None]
 
-        verify_key = nacl.signing.VerifyKey(bytes(auth_info['public_signing_key'], encoding='ascii'),
-                                            encoder=nacl.encoding.Base64Encoder)
+        # blades that don't say which cipher suite they're using use the
+        # default one
+        suite = auth_info.get('suite', cipher_suites.DEFAULT)
+        if suite not in cipher_suites.SUITES:
+            return [None]
 
-        client_public_signing_key = auth_info['public_signing_key']
-        client_dh_public_key = base64.urlsafe_b64decode(
-            bytes(auth_info['dh_public_key'], encoding='ascii'))
-        client_signed_dh_public_key = base64.urlsafe_b64decode(
-            bytes(auth_info['signed_dh_public_key'], encoding='ascii'))
+        # keys that aren't even the right shape are a bad request, rather
+        # than an authorization that fails
+        try:
+            verify_key = signing_keys.verify_key(
+                auth_info['public_signing_key'])
+
+            client_public_signing_key = auth_info['public_signing_key']
+            client_dh_public_key = base64.urlsafe_b64decode(
+                bytes(auth_info['dh_public_key'], encoding='ascii'))
+            client_signed_dh_public_key = base64.urlsafe_b64decode(
+                bytes(auth_info['signed_dh_public_key'], encoding='ascii'))
+        except ValueError:
+            return None
+
+        if not cipher_suites.SUITES[suite].valid_public_key(client_dh_public_key):
+            return None
 
         try:
             verify_key.verify(client_dh_public_key,
                               client_signed_dh_public_key)
 
-        except nacl.exceptions.BadSignatureError:
+        except (nacl.exceptions.BadSignatureError, ValueError):
             return [None]
 
-        return [{
+        verified = {
             'public_signing_key': auth_info['public_signing_key'],
+            'suite': suite,
             'dh_public_key': client_dh_public_key,
             'signed_dh_public_key': client_signed_dh_public_key
-        }]
+        }
+        BladeAuthorization.cache.put(key, verified)
+
+        return [dict(verified)]
@@ -0,0 +1,41 @@
+import src.cursors as cursors
+import src.sorted_index as sorted_index
+
+
+def test_cursor_round_trip():
+    key = ('2020-01-02T03:04:05.000006', 'f00d')
+    assert cursors.decode_cursor(cursors.encode_cursor(key)) == key
+
+
+def test_cursor_for_record():
+    record = {'id': 'abc', 'publish_datetime': '2020-01-01T00:00:00',
+              'subscribe_datetime': '2021-01-01T00:00:00'}
+
+    assert cursors.decode_cursor(cursors.cursor_for(record)) == \
+        ('2020-01-01T00:00:00', 'abc')
+    assert cursors.decode_cursor(cursors.cursor_for(record, 'subscribe_datetime')) == \
+        ('2021-01-01T00:00:00', 'abc')
+
+
+def test_bare_ids_are_not_cursors():
+    for s in ['0123456789abcdef0123456789abcd', '', 'not base64!',
+              cursors.encode_cursor(('only one',) * 3)]:
+        assert cursors.decode_cursor(s) is None
+        assert cursors.parse_last_seen(s) == s
+        assert cursors.id_for_last_seen(s) == s
+
+
+def test_id_for_last_seen():
+    cursor = cursors.encode_cursor(('2020-01-01T00:00:00', 'abc'))
+    assert cursors.id_for_last_seen(cursor) == 'abc'
+
+
+def test_key_for_last_seen():
+    index = sorted_index.SortedIndex(
+        [{'id': 'abc', 'publish_datetime': '2020-01-01T00:00:00'}])
+    key = ('2020-01-01T00:00:00', 'abc')
+
+    assert cursors.key_for_last_seen(None, index) is None
+    assert cursors.key_for_last_seen(key, index) == key
+    assert cursors.key_for_last_seen('abc', index) == key
+    assert cursors.key_for_last_seen('missing', index) is None
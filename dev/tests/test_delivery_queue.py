@@ -0,0 +1,112 @@
+import requests
+
+import src.config as config
+import src.delivery_queue as delivery_queue
+import src.peer_health as peer_health
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+class FakePeerHealth(object):
+    cooldown = 60
+
+
+# Records what's posted, and answers each url with the next of its status
+# codes, or raises the next of its exceptions, or 200 once they run out.
+class FakeHTTPClient(object):
+
+    def __init__(self, answers={}):
+        self.answers = {url: list(a) for url, a in answers.items()}
+        self.posted = []
+        self.peer_health = FakePeerHealth()
+
+    def post(self, url, data):
+        self.posted += [(url, data)]
+        answers = self.answers.get(url)
+        answer = answers.pop(0) if answers else 200
+        if isinstance(answer, Exception):
+            raise answer
+        return FakeResponse(answer)
+
+
+def queue(tmp_path, answers={}, **cfg):
+    config.save_config(str(tmp_path), {'storage_backend': 'sqlite',
+                                       'delivery_backoff': 5,
+                                       'delivery_max_backoff': 12,
+                                       **cfg})
+    return delivery_queue.DeliveryQueue(str(tmp_path), FakeHTTPClient(answers))
+
+
+# Makes every queued delivery due, as if its backoff had passed.
+def make_due(q):
+    for delivery in q.delivery_queue_db.all():
+        q.delivery_queue_db.update({'next_attempt_datetime': None},
+                                   id=delivery['id'])
+
+
+def test_deliveries_to_each_url_are_made_in_order(tmp_path):
+    q = queue(tmp_path)
+    for url, payload in [('a', '1'), ('b', '1'), ('a', '2'), ('a', '3')]:
+        q.enqueue(url, payload)
+
+    assert q.deliver_due() is None
+    assert [payload for url, payload in q.http_client.posted if url == 'a'] == \
+        ['1', '2', '3']
+    assert len(q.delivery_queue_db) == 0
+
+
+def test_failed_delivery_backs_off_and_holds_up_later_ones(tmp_path):
+    q = queue(tmp_path, {'a': [500, requests.exceptions.ConnectionError('a'), 500]})
+    q.enqueue('a', '1')
+    q.enqueue('a', '2')
+
+    waits = []
+    for _ in range(3):
+        waits += [q.deliver_due()]
+        # nothing's due until the backoff has passed
+        assert q.deliver_due() > 0
+        make_due(q)
+
+    assert waits == [5, 10, 12]
+    assert q.http_client.posted == [('a', '1')] * 3
+    assert q.delivery_queue_db.get(payload='1')['attempts'] == 3
+
+    assert q.deliver_due() is None
+    assert q.http_client.posted[3:] == [('a', '1'), ('a', '2')]
+
+
+def test_gives_up_after_max_attempts(tmp_path):
+    q = queue(tmp_path, {'a': [500, 500]}, delivery_max_attempts=2)
+    q.enqueue('a', '1')
+    q.enqueue('a', '2')
+
+    q.deliver_due()
+    make_due(q)
+    assert q.deliver_due() is None
+    assert q.http_client.posted == [('a', '1'), ('a', '1'), ('a', '2')]
+
+
+def test_unavailable_blade_doesnt_use_up_attempts(tmp_path):
+    q = queue(tmp_path, {'a': [peer_health.PeerUnavailable('a')]})
+    q.enqueue('a', '1')
+
+    assert q.deliver_due() == FakePeerHealth.cooldown
+    assert q.delivery_queue_db.get(payload='1')['attempts'] == 0
+
+
+def test_waiting_delivery_isnt_queued_twice(tmp_path):
+    q = queue(tmp_path)
+    q.enqueue('a', '1')
+    q.enqueue('a', '1')
+    q.enqueue('a', '2')
+    q.enqueue('b', '1')
+    assert len(q.delivery_queue_db) == 3
+
+    # one that's being posted might already have been acted on
+    q.in_flight.add(q.delivery_queue_db.get(url='a', payload='1')['id'])
+    q.enqueue('a', '1')
+    assert len(q.delivery_queue_db) == 4
@@ -0,0 +1,153 @@
+import base64
+import json
+
+import nacl.encoding
+import nacl.signing
+
+import src.cipher_suites as cipher_suites
+import src.encryption_manager as encryption_manager
+
+
+class FakeIdentityManager(object):
+
+    def __init__(self):
+        self.key = nacl.signing.SigningKey.generate()
+
+    def public_signing_key(self):
+        return str(self.key.verify_key.encode(encoder=nacl.encoding.Base64Encoder),
+                   encoding='ascii')
+
+    def signing_key(self):
+        return self.key
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body=''):
+        self.status_code = status_code
+        self.text = body
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+
+# Answers requests the way blade.py does, with an encrypted 'hello', for a
+# blade that supports the given cipher suites.
+class FakeServer(object):
+
+    def __init__(self, tmp_path, suites=cipher_suites.PREFERENCE):
+        self.identity_manager = FakeIdentityManager()
+        self.encryption_manager = encryption_manager.EncryptionManager(
+            str(tmp_path), self.identity_manager)
+        self.suites = suites
+        self.authorizations = []
+        self.replay = False
+        self.last_response = None
+
+    def get(self, url, headers):
+        authorization = json.loads(
+            headers['Authorization'][len('LabrysBlade '):])
+        self.authorizations += [authorization]
+
+        if 'session_id' in authorization:
+            if self.replay:
+                return self.last_response
+            authorization = self.encryption_manager.resume_session(
+                authorization)
+            if authorization is None:
+                return FakeResponse(401)
+        else:
+            if authorization.get('suite', cipher_suites.DEFAULT) not in self.suites:
+                return FakeResponse(400)
+            authorization['dh_public_key'] = base64.urlsafe_b64decode(
+                bytes(authorization['dh_public_key'], encoding='ascii'))
+
+        self.last_response = FakeResponse(200, json.dumps(
+            self.encryption_manager.encrypt_server_response(authorization, 'hello')))
+        return self.last_response
+
+
+def client(tmp_path):
+    return encryption_manager.EncryptionManager(str(tmp_path),
+                                                FakeIdentityManager())
+
+
+def request(client, server):
+    return client.encrypted_client_request(
+        server.identity_manager.public_signing_key(), server.get, 'url')
+
+
+def handshakes(server):
+    return len([auth for auth in server.authorizations if 'session_id' not in auth])
+
+
+def test_requests_resume_the_session(tmp_path):
+    alice = client(tmp_path)
+    bob = FakeServer(tmp_path)
+
+    assert [request(alice, bob) for _ in range(3)] == ['hello'] * 3
+    assert handshakes(bob) == 1
+
+    nonces = [auth['nonce'] for auth in bob.authorizations[1:]]
+    assert len(set(nonces)) == 2
+
+
+def test_expired_session_does_a_handshake(tmp_path):
+    alice = client(tmp_path)
+    bob = FakeServer(tmp_path)
+    assert request(alice, bob) == 'hello'
+
+    bob.encryption_manager.server_sessions.clear()
+    assert request(alice, bob) == 'hello'
+    assert handshakes(bob) == 2
+
+
+def test_replayed_response_is_rejected(tmp_path):
+    alice = client(tmp_path)
+    bob = FakeServer(tmp_path)
+    assert request(alice, bob) == 'hello'
+    assert request(alice, bob) == 'hello'
+
+    # an earlier response on the session doesn't decrypt with a new nonce,
+    # so the session is dropped and a new handshake is done
+    bob.replay = True
+    assert request(alice, bob) == 'hello'
+    assert handshakes(bob) == 2
+
+
+def test_handshakes_switch_to_the_preferred_suite(tmp_path):
+    alice = client(tmp_path)
+    bob = FakeServer(tmp_path)
+
+    assert request(alice, bob) == 'hello'
+    alice.client_sessions.clear()
+    assert request(alice, bob) == 'hello'
+
+    assert [auth.get('suite') for auth in bob.authorizations] == \
+        [None, cipher_suites.X25519ChaCha20Poly1305.name]
+
+
+def test_falls_back_to_the_default_suite(tmp_path):
+    alice = client(tmp_path)
+    bob = FakeServer(tmp_path)
+    assert request(alice, bob) == 'hello'
+
+    # bob is downgraded to a version that only knows the default suite
+    bob.suites = [cipher_suites.DEFAULT]
+    alice.client_sessions.clear()
+    assert request(alice, bob) is None
+    assert request(alice, bob) == 'hello'
+
+    assert [auth.get('suite') for auth in bob.authorizations] == \
+        [None, cipher_suites.X25519ChaCha20Poly1305.name, None]
+
+
+def test_x25519_rejects_keys_of_small_order():
+    suite = cipher_suites.X25519ChaCha20Poly1305
+    key = suite.serialize_public_key(suite.generate_private_key())
+
+    assert suite.valid_public_key(key)
+    assert not suite.valid_public_key(key[:31])
+    assert not suite.valid_public_key(bytes(32))
+    assert not suite.valid_public_key(b'\x01' + bytes(31))
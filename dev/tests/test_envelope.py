@@ -0,0 +1,31 @@
+import struct
+
+import src.envelope as envelope
+
+
+def test_pack_unpack_round_trip():
+    info = {'public_signing_key': 'key', 'session_id': 'abc'}
+    ciphertext = bytes(range(256))
+
+    unpacked_info, unpacked_ciphertext = envelope.unpack(
+        envelope.pack(info, ciphertext))
+
+    assert unpacked_info == info
+    assert isinstance(unpacked_ciphertext, memoryview)
+    assert bytes(unpacked_ciphertext) == ciphertext
+
+
+def test_empty_ciphertext():
+    assert bytes(envelope.unpack(envelope.pack({}, b''))[1]) == b''
+
+
+def test_unpack_rejects_what_isnt_an_envelope():
+    header = b'{"a": 1}'
+
+    assert envelope.unpack(b'') is None
+    assert envelope.unpack(b'\x00\x00') is None
+    # header longer than the data
+    assert envelope.unpack(struct.pack('>I', 100) + header) is None
+    # header that isn't JSON, or isn't an object
+    assert envelope.unpack(struct.pack('>I', 3) + b'{{{') is None
+    assert envelope.unpack(struct.pack('>I', 2) + b'[]') is None
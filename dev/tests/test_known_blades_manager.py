@@ -0,0 +1,100 @@
+import json
+
+import requests
+
+import src.config as config
+import src.known_blades_manager as known_blades_manager
+
+
+class FakeResponse(object):
+
+    def __init__(self, status_code, body=''):
+        self.status_code = status_code
+        self.text = body
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.text)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+# Answers requests from a map of url -> response, or raises ConnectionError
+# for urls it doesn't know.
+class FakeHTTPClient(object):
+
+    def __init__(self, responses):
+        self.responses = responses
+
+    def get(self, url, **kwargs):
+        if url not in self.responses:
+            raise requests.exceptions.ConnectionError(url)
+        return self.responses[url]
+
+
+def bundle(public_signing_key, display_name, version):
+    return FakeResponse(200, json.dumps({'public_signing_key': public_signing_key,
+                                         'display_name': display_name,
+                                         'bio': display_name + ' bio',
+                                         'avatar_hash': None,
+                                         'version': version}))
+
+
+def manager(tmp_path, responses):
+    config.save_config(str(tmp_path), {'storage_backend': 'sqlite'})
+    return known_blades_manager.KnownBladesManager(str(tmp_path),
+                                                   FakeHTTPClient(responses))
+
+
+def test_loads_and_updates_identity(tmp_path):
+    responses = {'http://victim/api/identity': bundle('key', 'Victim', '1')}
+    known = manager(tmp_path, responses)
+
+    assert known.load_and_cache_blade_identity('victim')['display_name'] == 'Victim'
+
+    responses['http://victim/api/identity'] = bundle('key', 'Renamed', '2')
+    assert known.load_and_cache_blade_identity('victim')['display_name'] == 'Renamed'
+    assert known.cached_blade_identity('key')['display_name'] == 'Renamed'
+
+
+def test_another_url_cant_take_over_a_known_blade(tmp_path):
+    responses = {'http://victim/api/identity': bundle('key', 'Victim', '1'),
+                 'http://attacker/api/identity': bundle('key', 'Attacker', '2')}
+    known = manager(tmp_path, responses)
+    known.load_and_cache_blade_identity('victim')
+
+    loaded = known.load_and_cache_blade_identity('attacker')
+
+    assert loaded['url'] == 'victim'
+    assert loaded['display_name'] == 'Victim'
+    assert known.cached_blade_identity('key')['url'] == 'victim'
+    assert len(known.all_known_blades()) == 1
+
+
+def test_malformed_bundle_counts_as_unreachable(tmp_path):
+    responses = {'http://blade/api/identity': bundle('key', 'Blade', '1')}
+    known = manager(tmp_path, responses)
+    known.load_and_cache_blade_identity('blade')
+
+    for body in ['not json', '[]', '{"public_signing_key": "key"}']:
+        responses['http://blade/api/identity'] = FakeResponse(200, body)
+        assert known.load_and_cache_blade_identity('blade')['display_name'] == 'Blade'
+
+
+def test_one_malformed_bundle_doesnt_stop_revalidation(tmp_path):
+    responses = {'http://bad/api/identity': bundle('bad key', 'Bad', '1'),
+                 'http://good/api/identity': bundle('good key', 'Good', '1')}
+    known = manager(tmp_path, responses)
+    known.avatar_ttl = 0
+    known.load_and_cache_blade_identity('bad')
+    known.load_and_cache_blade_identity('good')
+
+    responses['http://bad/api/identity'] = FakeResponse(200, 'not json')
+    responses['http://good/api/identity'] = bundle('good key', 'Renamed', '2')
+    known.revalidate_avatars()
+
+    assert known.cached_blade_identity('good key')['display_name'] == 'Renamed'
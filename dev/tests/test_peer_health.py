@@ -0,0 +1,75 @@
+import pytest
+
+import src.config as config
+import src.peer_health as peer_health
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(peer_health, 'time', clock)
+    return clock
+
+
+def health(tmp_path):
+    config.save_config(str(tmp_path), {'peer_failure_threshold': 3,
+                                       'peer_cooldown': 60})
+    return peer_health.PeerHealth(str(tmp_path))
+
+
+def available(health, host):
+    try:
+        health.check(host)
+    except peer_health.PeerUnavailable:
+        return False
+    return True
+
+
+def test_opens_after_failures_in_a_row(tmp_path, clock):
+    peers = health(tmp_path)
+
+    peers.record_failure('a')
+    peers.record_failure('a')
+    peers.record_success('a', 0.1)
+    peers.record_failure('a')
+    peers.record_failure('a')
+    assert available(peers, 'a')
+
+    peers.record_failure('a')
+    assert not available(peers, 'a')
+    assert available(peers, 'b')
+    assert peers.stats()['a']['available'] is False
+
+
+def test_lets_one_probe_through_after_the_cooldown(tmp_path, clock):
+    peers = health(tmp_path)
+    for _ in range(3):
+        peers.record_failure('a')
+
+    clock.now += 59
+    assert not available(peers, 'a')
+
+    clock.now += 1
+    assert available(peers, 'a')
+    assert not available(peers, 'a')
+
+    # a failed probe keeps it open for another cooldown
+    peers.record_failure('a')
+    assert not available(peers, 'a')
+    clock.now += 60
+    assert available(peers, 'a')
+
+    # and a successful one closes it
+    peers.record_success('a', 0.1)
+    assert available(peers, 'a')
+    assert available(peers, 'a')
+    assert peers.stats()['a']['consecutive_failures'] == 0
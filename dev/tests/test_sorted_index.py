@@ -0,0 +1,71 @@
+import src.sorted_index as sorted_index
+import src.storage as storage
+
+
+def record(n, day=None):
+    return {'id': '%02d' % n,
+            'publish_datetime': '2020-01-%02dT00:00:00' % (day or n),
+            'even': n % 2 == 0}
+
+
+def table(tmp_path, records):
+    feed = storage.open_storage(str(tmp_path), 'sqlite').table('feed')
+    feed.insert_multiple(records)
+    return feed
+
+
+def ids(records):
+    return [rec['id'] for rec in records]
+
+
+def test_page_is_newest_first_from_the_key(tmp_path):
+    records = [record(n) for n in range(1, 6)]
+    index = sorted_index.SortedIndex(records)
+    feed = table(tmp_path, records)
+
+    assert ids(index.page(feed, None, 2)) == ['05', '04']
+    assert ids(index.page(feed, index.key_for_id('04'), 2)) == ['03', '02']
+    assert ids(index.page(feed, index.key_for_id('02'), 2)) == ['01']
+    assert ids(index.page(feed, index.key_for_id('01'), 2)) == []
+
+
+def test_page_breaks_ties_by_id(tmp_path):
+    records = [record(n, 1) for n in range(1, 4)]
+    index = sorted_index.SortedIndex(records)
+    feed = table(tmp_path, records)
+
+    assert ids(index.page(feed)) == ['03', '02', '01']
+    assert ids(index.page(feed, index.key_for_id('03'), 1)) == ['02']
+
+
+def test_page_filters_across_chunks(tmp_path):
+    records = [record(n) for n in range(1, 31)]
+    index = sorted_index.SortedIndex(records)
+    feed = table(tmp_path, records)
+
+    # more records are filtered out than fit in one chunk
+    odd = index.page(feed, None, 12, lambda rec: not rec['even'])
+    assert ids(odd) == ['%02d' % n for n in range(29, 6, -2)]
+
+
+def test_page_skips_records_missing_from_the_table(tmp_path):
+    records = [record(n) for n in range(1, 4)]
+    index = sorted_index.SortedIndex(records)
+    feed = table(tmp_path, records)
+    feed.remove(id='02')
+
+    assert ids(index.page(feed, None, 2)) == ['03', '01']
+
+
+def test_add_moves_and_remove_drops(tmp_path):
+    records = [record(n) for n in range(1, 4)]
+    index = sorted_index.SortedIndex(records)
+
+    index.add(record(1, 9))
+    index.remove('02')
+    index.remove('missing')
+
+    assert index.ids_before() == ['01', '03']
+    assert index.ids_after() == ['03', '01']
+    assert '02' not in index
+    assert len(index) == 2
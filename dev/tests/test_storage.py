@@ -0,0 +1,122 @@
+import pytest
+
+import src.storage as storage
+
+
+@pytest.fixture(params=sorted(storage.BACKENDS))
+def backend(request):
+    return request.param
+
+
+@pytest.fixture
+def store(backend, tmp_path):
+    return storage.open_storage(str(tmp_path), backend)
+
+
+def ids(docs):
+    return sorted(doc['id'] for doc in docs)
+
+
+def test_insert_and_search(store):
+    feed = store.table('feed')
+    feed.insert({'id': 'a', 'x': 1})
+    feed.insert_multiple([{'id': 'b', 'x': 2}, {'id': 'c', 'x': 2}])
+
+    assert ids(feed.all()) == ['a', 'b', 'c']
+    assert ids(feed.search(x=2)) == ['b', 'c']
+    assert ids(feed.search_in('id', ['a', 'c', 'z'])) == ['a', 'c']
+    assert feed.get(id='b') == {'id': 'b', 'x': 2}
+    assert feed.get(id='z') is None
+    assert len(feed) == 3
+
+
+def test_update_and_remove(store):
+    feed = store.table('feed')
+    feed.insert_multiple([{'id': 'a', 'x': 1}, {'id': 'b', 'x': 2},
+                          {'id': 'c', 'x': 3}])
+
+    feed.update({'x': 9, 'y': 'new'}, id='a')
+    assert feed.get(id='a') == {'id': 'a', 'x': 9, 'y': 'new'}
+
+    feed.remove(id='b')
+    feed.remove_in('id', ['c'])
+    assert ids(feed.all()) == ['a']
+
+
+def test_missing_fields_match_none(store):
+    feed = store.table('feed')
+    feed.insert_multiple([{'id': 'a', 'x': None}, {'id': 'b'},
+                          {'id': 'c', 'x': 1}])
+
+    assert ids(feed.search(x=None)) == ['a', 'b']
+    assert ids(feed.search_in('x', [None, 1])) == ['a', 'b', 'c']
+
+    feed.remove_in('x', [None])
+    assert ids(feed.all()) == ['c']
+
+
+def test_project(store):
+    feed = store.table('feed')
+    feed.insert_multiple([{'id': 'a', 'x': 1, 'body': 'long'},
+                          {'id': 'b', 'body': 'long'}])
+
+    with store.batch():
+        feed.insert({'id': 'c', 'x': 3, 'body': 'long'})
+        assert sorted(feed.project('id', 'x'), key=lambda doc: doc['id']) == [
+            {'id': 'a', 'x': 1}, {'id': 'b', 'x': None}, {'id': 'c', 'x': 3}]
+
+
+def test_reads_inside_a_batch_see_its_writes(store):
+    feed = store.table('feed')
+    feed.insert({'id': 'a', 'x': 1})
+
+    with store.batch():
+        feed.insert({'id': 'b', 'x': 2})
+        feed.update({'x': 3}, id='a')
+
+        assert ids(feed.all()) == ['a', 'b']
+        assert ids(feed.search(x=2)) == ['b']
+        assert ids(feed.search_in('id', ['b'])) == ['b']
+        assert feed.get(id='a')['x'] == 3
+
+    assert ids(feed.all()) == ['a', 'b']
+
+
+def test_failed_batch_is_rolled_back(backend, store, tmp_path):
+    feed = store.table('feed')
+    feed.insert_multiple([{'id': 'a', 'x': 1}, {'id': 'b', 'x': 2}])
+
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            feed.insert({'id': 'c', 'x': 3})
+            feed.update({'x': 9}, id='a')
+            feed.remove(id='b')
+            raise RuntimeError
+
+    assert sorted((doc['id'], doc['x']) for doc in feed.all()) == [('a', 1), ('b', 2)]
+
+    feed.insert({'id': 'd', 'x': 4})
+    assert ids(feed.all()) == ['a', 'b', 'd']
+
+    # TinyDB's CachingMiddleware writes on its own after 1000 writes, which
+    # a big batch mustn't do
+    with pytest.raises(RuntimeError):
+        with store.batch():
+            for i in range(1500):
+                feed.insert({'id': str(i)})
+            raise RuntimeError
+
+    assert ids(feed.all()) == ['a', 'b', 'd']
+    assert ids(storage.BACKENDS[backend](str(tmp_path)).table('feed').all()) == ['a', 'b', 'd']
+
+
+def test_writes_are_kept_when_reopened(backend, store, tmp_path):
+    feed = store.table('feed')
+    with store.batch():
+        feed.insert_multiple([{'id': 'a', 'x': 1}, {'id': 'b', 'x': 2}])
+    feed.update({'x': 5}, id='a')
+    feed.remove(id='b')
+
+    reopened = storage.BACKENDS[backend](str(tmp_path)).table('feed')
+
+    assert reopened.all() == [{'id': 'a', 'x': 5}]
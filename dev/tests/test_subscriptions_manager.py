@@ -0,0 +1,45 @@
+import threading
+import time
+
+import src.config as config
+import src.subscriptions_manager as subscriptions_manager
+
+
+def manager(tmp_path, **cfg):
+    config.save_config(str(tmp_path), {'storage_backend': 'sqlite', **cfg})
+    return subscriptions_manager.SubscriptionsManager(str(tmp_path),
+                                                      None, None, None, None, None, None)
+
+
+def subscription(name, day):
+    return {'id': name,
+            'subscribe_datetime': '2020-01-0' + str(day) + 'T00:00:00',
+            'public_signing_key': name,
+            'url': name}
+
+
+def test_slow_subscription_is_given_up_on(tmp_path):
+    subs = manager(tmp_path, subscription_fetch_concurrency=1,
+                   subscription_fetch_timeout=0.2)
+    subs.subscriptions_db.insert_multiple([subscription('slow', 1),
+                                           subscription('fast', 2)])
+
+    # the slow blade doesn't answer until the test is over
+    released = threading.Event()
+
+    def fetch_feed(sub):
+        if sub['url'] == 'slow':
+            released.wait()
+        return [{'id': sub['url'] + ' message'}], {}
+    subs.fetch_feed = fetch_feed
+
+    try:
+        start = time.monotonic()
+        messages, updates = subs.fetch_subscriptions()
+        assert time.monotonic() - start < 1
+    finally:
+        released.set()
+
+    assert messages == [{'id': 'fast message'}]
+    assert updates['slow']['fetch_failures'] == 1
+    assert updates['fast']['fetch_failures'] == 0
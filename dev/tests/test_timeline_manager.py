@@ -0,0 +1,115 @@
+import src.config as config
+import src.cursors as cursors
+import src.timeline_manager as timeline_manager
+
+
+# Hands out the given messages on the next fetch.
+class FakeSubscriptionsManager(object):
+
+    def __init__(self):
+        self.messages = []
+
+    def fetch_subscriptions(self, public_signing_keys=None, only_due=False):
+        messages, self.messages = self.messages, []
+        return messages, []
+
+    def record_fetch_state(self, updates):
+        pass
+
+
+class FakeKnownBladesManager(object):
+
+    def cached_blade_identity(self, public_signing_key):
+        return None
+
+
+def message(public_signing_key, origin_id, day, content=None):
+    return {'id': public_signing_key + '-' + origin_id + '-' + day,
+            'public_signing_key': public_signing_key,
+            'origin_id': origin_id,
+            'publish_datetime': '2020-01-' + day + 'T00:00:00',
+            'retrieve_datetime': '2020-02-' + day + 'T00:00:00',
+            'type': 'post',
+            'content': content or origin_id}
+
+
+def manager(tmp_path, **cfg):
+    config.save_config(str(tmp_path), {'storage_backend': 'sqlite', **cfg})
+    return timeline_manager.TimelineManager(str(tmp_path),
+                                            None,
+                                            FakeSubscriptionsManager(),
+                                            FakeKnownBladesManager())
+
+
+def refresh(timeline, messages):
+    timeline.subscriptions_manager.messages = messages
+    timeline.update_subscriptions()
+
+
+def cached_ids(timeline):
+    return sorted(msg['id'] for msg in timeline.timeline_cache_db.all())
+
+
+def test_per_subscription_retention_archives_the_oldest(tmp_path):
+    timeline = manager(tmp_path, timeline_retention_max_per_subscription=2)
+
+    # retention only needs the indexes, not the cached messages
+    def fail():
+        raise AssertionError('read the whole timeline cache')
+    timeline.timeline_cache_db.all = fail
+
+    refresh(timeline, [message('a', '1', '01'), message('a', '2', '02'),
+                       message('b', '1', '01')])
+    refresh(timeline, [message('a', '3', '03')])
+    del timeline.timeline_cache_db.all
+
+    assert cached_ids(timeline) == ['a-2-02', 'a-3-03', 'b-1-01']
+    assert [msg['id'] for msg in timeline.timeline_archive.page()] == ['a-1-01']
+
+    # and the indexes built from the cache agree
+    timeline.build_indexes()
+    assert len(timeline.subscription_indexes['a']) == 2
+    assert len(timeline.subscription_indexes['b']) == 1
+
+
+def test_timeline_pages_into_the_archive(tmp_path):
+    timeline = manager(tmp_path, timeline_retention_max_messages=2)
+    refresh(timeline, [message('a', str(day), '0' + str(day))
+                       for day in range(1, 6)])
+
+    assert cached_ids(timeline) == ['a-4-04', 'a-5-05']
+
+    messages, last_seen = timeline.timeline()
+    assert [msg['id'] for msg in messages] == ['a-5-05', 'a-4-04', 'a-3-03']
+
+    messages, last_seen = timeline.timeline(cursors.parse_last_seen(last_seen))
+    assert [msg['id'] for msg in messages] == ['a-2-02', 'a-1-01']
+    assert last_seen is None
+
+
+def test_refetched_message_is_cached_once(tmp_path):
+    timeline = manager(tmp_path)
+    refresh(timeline, [message('a', '1', '01')])
+
+    refetched = message('a', '1', '01', 'edited')
+    refetched['id'] = 'another id'
+    refresh(timeline, [refetched])
+
+    assert cached_ids(timeline) == ['a-1-01']
+    assert timeline.timeline_cache_db.get(id='a-1-01')['content'] == 'edited'
+
+
+def test_deduplicate_timeline_cache_keeps_the_first_copy(tmp_path):
+    timeline = manager(tmp_path)
+    first = message('a', '1', '01')
+    second = {**message('a', '1', '01'), 'id': 'copy',
+              'retrieve_datetime': '2020-03-01T00:00:00'}
+    timeline.timeline_cache_db.insert_multiple([second, first,
+                                                message('b', '1', '01')])
+    timeline.build_indexes()
+
+    assert timeline.deduplicate_timeline_cache() == 1
+    assert cached_ids(timeline) == ['a-1-01', 'b-1-01']
+    assert timeline.origin_index[('a', '1')] == 'a-1-01'
+    assert 'copy' not in timeline.timeline_index
+    assert 'copy' not in timeline.subscription_indexes['a']